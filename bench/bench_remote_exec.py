@@ -0,0 +1,35 @@
+"""
+measure repeated remote_exec submissions of the same function and module.
+
+usage: python bench/bench_remote_exec.py [NUMBER_OF_SUBMISSIONS]
+"""
+import sys, time
+import execnet
+
+def echo(channel, value):
+    channel.send(value)
+
+def bench(name, gw, submit, n):
+    start = time.time()
+    channels = [submit(i) for i in range(n)]
+    submitted = time.time() - start
+    for channel in channels:
+        channel.receive()
+    duration = time.time() - start
+    print("%s: submit %.3fs  total %.3fs  (%d calls)" % (
+          name, submitted, duration, n))
+
+def main(args):
+    n = args and int(args[0]) or 5000
+    gw = execnet.makegateway()
+    try:
+        bench("function", gw, lambda i: gw.remote_exec(echo, value=i), n)
+        module = sys.modules[__name__]
+        bench("module", gw, lambda i: gw.remote_exec(module), n)
+    finally:
+        gw.exit()
+
+if __name__ == "__channelexec__":
+    channel.send(None)  # noqa
+elif __name__ == "__main__":
+    main(sys.argv[1:])
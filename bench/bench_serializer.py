@@ -0,0 +1,45 @@
+"""
+compare serialization speed and size of execnet's format versions.
+
+usage: python bench/bench_serializer.py [NUMBER_OF_KEYS]
+"""
+import sys, time
+from execnet import gateway_base
+
+def bestof(func, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+def bench(name, obj):
+    print("%s:" % (name,))
+    for version in range(1, gateway_base.INTERNAL_FORMAT_VERSION + 1):
+        serializer = lambda: gateway_base._Serializer(version=version)
+        data = serializer().save(obj)
+        dumptime = bestof(lambda: serializer().save(obj))
+        loadtime = bestof(lambda: gateway_base.loads_internal(data))
+        print("  version %d: %8d bytes  dump %.3fs  load %.3fs" % (
+              version, len(data), dumptime, loadtime))
+
+def main(args):
+    n = args and int(args[0]) or 100000
+    bench("dict of %d str -> int" % (n,),
+          dict([("key%d" % i, i) for i in range(n)]))
+    bench("dict of %d int -> (str, float)" % (n,),
+          dict([(i, ("value", i / 3.0)) for i in range(n)]))
+    bench("list of %d int" % (n,), list(range(n)))
+    bench("list of %d float" % (n,), [i / 3.0 for i in range(n)])
+    bench("list of %d small lists" % (n,),
+          [[i, "x", None] for i in range(n)])
+    deep = []
+    for i in range(n):
+        deep = [deep]
+    bench("lists nested %d deep" % (n,), deep)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,9 +2,10 @@
 gateway code for initiating popen, socket and ssh connections.
 (c) 2004-2013, Holger Krekel and others
 """
+from __future__ import with_statement
 
 import sys, os, inspect, types, linecache
-import textwrap
+import textwrap, hashlib, weakref
 import execnet
 from execnet.gateway_base import Message
 from execnet import gateway_base
@@ -13,9 +14,22 @@ importdir = os.path.dirname(os.path.dirname(execnet.__file__))
 class Gateway(gateway_base.BaseGateway):
     """ Gateway to a local or remote Python Intepreter. """
 
-    def __init__(self, io, spec):
+    def __init__(self, io, spec, format=None):
         super(Gateway, self).__init__(io=io, id=spec.id, _startcount=1)
         self.spec = spec
+        self._codecachelock = self.execmodel.Lock()
+        self._registry = None
+        self._registrylock = self.execmodel.Lock()
+        self._sessioncount = 0
+        if format is not None:
+            self._set_format(*format)
+        if spec.coalesce:
+            self._start_writer(spec.coalesce)
+        if spec.compress:
+            if "zlib" in self._features:
+                self._start_compression(spec.compress)
+            else:
+                self._trace("not compressing, the other side has no zlib")
         self._initreceive()
 
     @property
@@ -47,20 +61,28 @@ class Gateway(gateway_base.BaseGateway):
             self._trace("--> sending GATEWAY_TERMINATE")
             self._send(Message.GATEWAY_TERMINATE)
             self._trace("--> io.close_write")
-            self._io.close_write()
+            self._close_write()
         except (ValueError, EOFError, IOError):
             v = sys.exc_info()[1]
             self._trace("io-error: could not send termination sequence")
             self._trace(" exception: %r" % v)
 
-    def reconfigure(self, py2str_as_py3str=True, py3str_as_py2str=False):
+    def reconfigure(self, py2str_as_py3str=True, py3str_as_py2str=False,
+                    codec=None):
         """
         set the string coercion for this gateway
         the default is to try to convert py2 str as py3 str,
-        but not to try and convert py3 str to py2 str
+        but not to try and convert py3 str to py2 str.
+        codec sets the codec of channels created afterwards,
+        see ``Channel.reconfigure``.
         """
         self._strconfig = (py2str_as_py3str, py3str_as_py2str)
-        data = gateway_base.dumps_internal(self._strconfig)
+        config = self._strconfig
+        if codec is not None:
+            gateway_base._check_codec(self, codec)
+            self._codec = codec
+            config += (codec,)
+        data = self._dumps(config)
         self._send(Message.RECONFIGURE, data=data)
 
 
@@ -101,10 +123,12 @@ class Gateway(gateway_base.BaseGateway):
             will be available in the global namespace of the remotely
             executing code.
         """
+        return self._remote_exec(source, kwargs)
+
+    def _remote_exec(self, source, kwargs, session=None):
         call_name = None
         if isinstance(source, types.ModuleType):
-            linecache.updatecache(inspect.getsourcefile(source))
-            source = inspect.getsource(source)
+            source = _source_of_module(source)
         elif isinstance(source, types.FunctionType):
             call_name = source.__name__
             source = _source_of_function(source)
@@ -115,11 +139,68 @@ class Gateway(gateway_base.BaseGateway):
             raise TypeError("can't pass kwargs to non-function remote_exec")
 
         channel = self.newchannel()
-        self._send(Message.CHANNEL_EXEC,
-                   channel.id,
-                   gateway_base.dumps_internal((source, call_name, kwargs)))
+        if "codecache" not in self._features:
+            self._send(Message.CHANNEL_EXEC,
+                       channel.id,
+                       self._dumps((source, call_name, kwargs)))
+            return channel
+        # the cache mirrors the one of the slave if we send in order
+        # and only update it for tasks which were sent
+        with self._codecachelock:
+            task = self._cached_task(source, call_name, kwargs)
+            key = task[3]
+            if session is not None:
+                task += (session,)
+            self._send(Message.CHANNEL_EXEC, channel.id, self._dumps(task))
+            if self._codecache.get(key) is None:
+                self._codecache.put(key, True)
         return channel
 
+    def session(self):
+        """ return a new Session whose ``remote_exec`` calls share
+        one persistent global namespace on the remote side. """
+        if "sessions" not in self._features:
+            raise ValueError("the other side does not support sessions")
+        with self._registrylock:
+            self._sessioncount += 1
+            return Session(self, self._sessioncount)
+
+    def _cached_task(self, source, call_name, kwargs):
+        """ return the CHANNEL_EXEC task with the key of the source
+        and the source or its marshalled code unless the slave has it
+        cached. """
+        data = source
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        key = hashlib.sha1(data).hexdigest()
+        if key in self._codecache:
+            return (None, call_name, kwargs, key, None)
+        marshal_feature = gateway_base.MARSHAL_FEATURE
+        if marshal_feature is not None and marshal_feature in self._features:
+            import marshal
+            try:
+                code = compile(source + '\n', '<remote exec>', 'exec')
+            except Exception:
+                pass  # let the slave report the error
+            else:
+                return (None, call_name, kwargs, key, marshal.dumps(code))
+        return (source, call_name, kwargs, key, None)
+
+    def register(self, function):
+        """ define ``function`` once in a namespace of the remote side
+        and return a RemoteFunction handle for calling it there with
+        keyword arguments.  Like functions passed to ``remote_exec``
+        it must not use closures or non-builtin globals, but it takes
+        no ``channel`` argument and its return value is sent back.
+        All calls of registered functions are sent through one channel
+        and execute one after another in one remote thread.
+        """
+        source = _source_of_function(function, channelarg=False)
+        with self._registrylock:
+            if self._registry is None:
+                self._registry = FunctionRegistry(self)
+        return self._registry.register(function.__name__, source)
+
     def remote_init_threads(self, num=None):
         """ DEPRECATED.  Is currently a NO-OPERATION already."""
         print ("WARNING: remote_init_threads() is a no-operation in execnet-1.2")
@@ -135,6 +216,135 @@ class RInfo:
 
 RemoteStatus = RInfo
 
+class Session(object):
+    """ a persistent global namespace on the remote side, shared by
+        the code executed with its ``remote_exec``.  Imported modules
+        and other state then survive from one execution to the next
+        until the session is closed.  The executions of a session run
+        one after the other in the order of their ``remote_exec`` calls,
+        an execution waiting for a later one of its session blocks.
+    """
+    def __init__(self, gateway, id):
+        self.gateway = gateway
+        self.id = id
+        self.closed = False
+
+    def __repr__(self):
+        return "<Session id=%d %s on %r>" % (
+            self.id, self.closed and "closed" or "open", self.gateway)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excinfo):
+        self.close()
+
+    def remote_exec(self, source, **kwargs):
+        """ like ``Gateway.remote_exec`` but executing in the
+        namespace of the session. """
+        if self.closed:
+            raise ValueError("%r is closed" % (self,))
+        return self.gateway._remote_exec(source, kwargs, session=self.id)
+
+    def close(self):
+        """ release the remote namespace once the executions
+        sent so far started. """
+        if not self.closed:
+            self.closed = True
+            self.gateway._send(Message.SESSION_CLOSE, self.id)
+
+class RemoteCall(object):
+    """ result of a call of a registered function. """
+    def __init__(self, execmodel):
+        self._ready = execmodel.Event()
+        self._result = self._error = None
+
+    def _set(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._ready.set()
+
+    def get(self, timeout=None):
+        """ return the result of the call or raise a RemoteError if it
+        raised.  A TimeoutError is raised if there is no result after
+        ``timeout`` seconds. """
+        if not self._ready.wait(timeout):
+            raise gateway_base.TimeoutError(
+                "no result after %r seconds" % (timeout,))
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+class RemoteFunction(object):
+    """ handle of a function registered with ``Gateway.register()``. """
+    def __init__(self, registry, funcid, name):
+        self._registry = registry
+        self._funcid = funcid
+        self.name = name
+
+    def __repr__(self):
+        return "<RemoteFunction %s on %r>" % (self.name,
+                                              self._registry.gateway)
+
+    def call(self, **kwargs):
+        """ call the function remotely and return its result. """
+        return self.call_async(**kwargs).get()
+
+    def call_async(self, **kwargs):
+        """ call the function remotely and return a RemoteCall
+        providing its result. """
+        return self._registry.call("call", self._funcid, kwargs)
+
+class FunctionRegistry(object):
+    """ master side of the channel to the namespace of registered
+    functions, it sends small call frames and dispatches the results. """
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self._lock = gateway.execmodel.Lock()
+        self._calls = {}
+        self._count = 0
+        self.channel = gateway.remote_exec(serve_registry_source)
+        self.channel.setcallback(self._receive, endmarker=None)
+
+    def register(self, name, source):
+        call = self.call("register", None, (name, source))
+        call.get()
+        return RemoteFunction(self, call.funcid, name)
+
+    def call(self, op, funcid, arg):
+        call = RemoteCall(self.gateway.execmodel)
+        with self._lock:
+            self._count += 1
+            callid = self._count
+            if funcid is None:
+                funcid = callid
+            self._calls[callid] = call
+        call.funcid = funcid
+        try:
+            self.channel.send((op, callid, funcid, arg))
+        except Exception:
+            with self._lock:
+                del self._calls[callid]
+            raise
+        return call
+
+    def _receive(self, item):
+        # executes in receiver thread
+        if item is None:
+            with self._lock:
+                calls = list(self._calls.values())
+                self._calls.clear()
+            for call in calls:
+                call._set(error=IOError("registry channel closed"))
+            return
+        callid, ok, value = item
+        with self._lock:
+            call = self._calls.pop(callid)
+        if ok:
+            call._set(result=value)
+        else:
+            call._set(error=gateway_base.RemoteError(value))
+
 def rinfo_source(channel):
     import sys, os
     channel.send(dict(
@@ -146,6 +356,25 @@ def rinfo_source(channel):
     ))
 
 
+def serve_registry_source(channel):
+    import sys
+    namespace = {'__name__': '__channelexec__'}
+    functions = {}
+    geterrortext = channel.gateway._geterrortext
+    for op, callid, funcid, arg in channel:
+        try:
+            if op == "register":
+                name, source = arg
+                eval(compile(source, '<remote exec>', 'exec'), namespace)
+                functions[funcid] = namespace[name]
+                result = None
+            else:
+                result = functions[funcid](**arg)
+            channel.send((callid, True, result))
+        except Exception:
+            channel.send((callid, False, geterrortext(sys.exc_info())))
+
+
 def _find_non_builtin_globals(source, codeobj):
     try:
         import ast
@@ -165,21 +394,64 @@ def _find_non_builtin_globals(source, codeobj):
     return all
 
 
-def _source_of_function(function):
+# function or module -> (filename, modification time, source)
+_source_cache = weakref.WeakKeyDictionary()
+
+def _getmtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except (OSError, TypeError):
+        return None
+
+def _cached_source(obj, getfilename, getsource):
+    """ return getsource(obj) for a function or module, computed again
+    only if the modification time of its source file changed. """
+    entry = _source_cache.get(obj)
+    if entry is not None and _getmtime(entry[0]) == entry[1]:
+        return entry[2]
+    filename = getfilename(obj)
+    mtime = _getmtime(filename)
+    if entry is not None:
+        linecache.checkcache(filename)
+    source = getsource(obj)
+    if mtime is not None:
+        _source_cache[obj] = (filename, mtime, source)
+    return source
+
+def _source_of_module(module):
+    def getsource(module):
+        linecache.updatecache(inspect.getsourcefile(module))
+        return inspect.getsource(module)
+    return _cached_source(module, inspect.getsourcefile, getsource)
+
+def _code_of_function(function):
+    if sys.version_info < (3,0):
+        return function.func_code
+    return function.__code__
+
+def _filename_of_function(function):
+    return _code_of_function(function).co_filename
+
+def _source_of_function(function, channelarg=True):
+    """ return the source of a function which uses neither closures nor
+    non-builtin globals and, if channelarg is true, takes a ``channel``
+    as first argument. """
     if function.__name__ == '<lambda>':
         raise ValueError("can't evaluate lambda functions'")
-    #XXX: we dont check before remote instanciation
-    #     if arguments are used propperly
-    args, varargs, keywords, defaults = inspect.getargspec(function)
-    if args[0] != 'channel':
-        raise ValueError('expected first function argument to be `channel`')
-
+    if channelarg:
+        codeobj = _code_of_function(function)
+        if codeobj.co_argcount < 1 or codeobj.co_varnames[0] != 'channel':
+            raise ValueError(
+                'expected first function argument to be `channel`')
+    return _cached_source(function, _filename_of_function,
+                          _read_source_of_function)
+
+def _read_source_of_function(function):
     if sys.version_info < (3,0):
         closure = function.func_closure
-        codeobj = function.func_code
     else:
         closure = function.__closure__
-        codeobj = function.__code__
+    codeobj = _code_of_function(function)
 
     if closure is not None:
         raise ValueError("functions with closures can't be passed")
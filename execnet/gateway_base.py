@@ -1,13 +1,14 @@
 """
 base execnet gateway code send to the other side for bootstrapping.
 
-NOTE: aims to be compatible to Python 2.5-3.X, Jython and IronPython
+NOTE: aims to be compatible to Python 2.6-3.X, Jython and IronPython
 
 (C) 2004-2013 Holger Krekel, Armin Rigo, Benjamin Peterson, Ronny Pfannschmidt and others
 """
 from __future__ import with_statement
 import sys, os, weakref
-import traceback, struct
+import traceback, struct, time, array, binascii
+from collections import deque
 
 # NOTE that we want to avoid try/except style importing
 # to avoid setting sys.exc_info() during import
@@ -15,14 +16,13 @@ import traceback, struct
 
 ISPY3 = sys.version_info >= (3, 0)
 if ISPY3:
-    from io import BytesIO
     exec("def do_exec(co, loc): exec(co, loc)\n"
          "def reraise(cls, val, tb): raise val\n")
     unicode = str
     _long_type = int
     from _thread import interrupt_main
+    from sys import intern
 else:
-    from StringIO import StringIO as BytesIO
     exec("def do_exec(co, loc): exec co in loc\n"
          "def reraise(cls, val, tb): raise cls, val, tb\n")
     bytes = str
@@ -32,6 +32,9 @@ else:
     except ImportError:
         interrupt_main = None
 
+# memoryview is missing before Python 2.7
+HAS_MEMORYVIEW = sys.version_info >= (2, 7)
+
 #f = open("/tmp/execnet-%s" % os.getpid(), "w")
 #def log_extra(*msg):
 #    f.write(" ".join([str(x) for x in msg]) + "\n")
@@ -126,8 +129,8 @@ def get_execmodel(backend):
         def fdopen(self, fd, mode, bufsize=1):
             return self._fdopen(fd, mode, bufsize)
 
-        def WorkerPool(self, hasprimary=False):
-            return WorkerPool(self, hasprimary=hasprimary)
+        def WorkerPool(self, hasprimary=False, **kwargs):
+            return WorkerPool(self, hasprimary=hasprimary, **kwargs)
 
         def Semaphore(self, size=None):
             if size is None:
@@ -208,14 +211,29 @@ class WorkerPool(object):
         itself into performing function execution through
         calling integrate_as_primary_thread() which will return
         when the pool received a trigger_shutdown().
+
+        Worker threads wait up to ``idletimeout`` seconds for
+        another function execution before they finish, except for
+        ``minsize`` of them.  If ``maxsize`` threads are busy,
+        further function executions wait for one of them.
     """
-    def __init__(self, execmodel, hasprimary=False):
+    def __init__(self, execmodel, hasprimary=False, minsize=0, maxsize=None,
+                 idletimeout=5.0):
         """ by default allow unlimited number of spawns. """
         self.execmodel = execmodel
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.idletimeout = idletimeout
         self._running_lock = self.execmodel.Lock()
         self._running = set()
         self._shuttingdown = False
         self._waitall_events = []
+        # replies are handed to idle workers through _tasks,
+        # _backlog holds those waiting for a worker if maxsize are busy
+        self._tasks = self.execmodel.queue.Queue()
+        self._backlog = deque()
+        self._numthreads = 0
+        self._idle = 0
         if hasprimary:
             if self.execmodel.backend != "thread":
                 raise ValueError("hasprimary=True requires thread model")
@@ -248,6 +266,10 @@ class WorkerPool(object):
             if self._primary_thread_task_ready is not None:
                 self._primary_thread_task = None
                 self._primary_thread_task_ready.set()
+            # wake up idle workers for finishing
+            while self._idle:
+                self._idle -= 1
+                self._tasks.put(None)
 
     def active_count(self):
         return len(self._running)
@@ -261,6 +283,33 @@ class WorkerPool(object):
                     waitall_event = self._waitall_events.pop()
                     waitall_event.set()
 
+    def _worker(self, reply):
+        while reply is not None:
+            self._perform_spawn(reply)
+            reply = self._next_task()
+
+    def _next_task(self):
+        # return the next reply for a worker or None if it is to finish
+        with self._running_lock:
+            if self._backlog:
+                return self._backlog.popleft()
+            if self._shuttingdown:
+                self._numthreads -= 1
+                return None
+            self._idle += 1
+        Empty = self.execmodel.queue.Empty
+        while 1:
+            try:
+                return self._tasks.get(timeout=self.idletimeout)
+            except Empty:
+                with self._running_lock:
+                    # spawn() decrements _idle when putting a reply, so
+                    # if it is zero there is a reply for us on its way
+                    if self._idle and self._numthreads > self.minsize:
+                        self._idle -= 1
+                        self._numthreads -= 1
+                        return None
+
     def _try_send_to_primary_thread(self, reply):
         # REF1 in 'thread' model we give priority to running in main thread
         # note that we should be called with _running_lock hold
@@ -283,7 +332,14 @@ class WorkerPool(object):
                 raise ValueError("pool is shutting down")
             self._running.add(reply)
             if not self._try_send_to_primary_thread(reply):
-                self.execmodel.start(self._perform_spawn, (reply,))
+                if self._idle:
+                    self._idle -= 1
+                    self._tasks.put(reply)
+                elif self.maxsize is None or self._numthreads < self.maxsize:
+                    self._numthreads += 1
+                    self.execmodel.start(self._worker, (reply,))
+                else:
+                    self._backlog.append(reply)
         return reply
 
     def terminate(self, timeout=None):
@@ -337,6 +393,71 @@ elif DEBUG:
 else:
     notrace = trace = lambda *msg: None
 
+IOV_MAX = 1024
+
+def write_buffers(writev, buffers):
+    """ write all buffers through a ``writev(buffers)`` function which
+    may write only part of the data and returns the number of bytes
+    written, e.g. os.writev or socket.sendmsg. """
+    buffers = [memoryview(buf) for buf in buffers if len(buf)]
+    i = 0
+    while i < len(buffers):
+        written = writev(buffers[i:i+IOV_MAX])
+        while written:
+            size = len(buffers[i])
+            if written >= size:
+                written -= size
+                i += 1
+            else:
+                buffers[i] = buffers[i][written:]
+                written = 0
+
+class ReadBuffer(object):
+    """ buffered reading on top of a ``readinto(buffer)`` function
+        which fills a writable buffer with whatever is available
+        and returns the number of bytes read (0 meaning EOF).
+
+        Small reads are served from a reusable bytearray which is
+        refilled with large reads, so that reading many small frames
+        needs far less than one system call per frame.  Reads larger
+        than the buffer go directly into the result buffer.
+    """
+    bufsize = 65536
+
+    def __init__(self, readinto):
+        self._readinto = readinto
+        self._buf = bytearray(self.bufsize)
+        self._view = memoryview(self._buf)
+        self._pos = self._end = 0
+
+    def read(self, numbytes):
+        """ read exactly 'numbytes' bytes. """
+        pos, end = self._pos, self._end
+        if end - pos >= numbytes:
+            self._pos = pos + numbytes
+            return self._view[pos:pos+numbytes].tobytes()
+        result = bytearray(numbytes)
+        view = memoryview(result)
+        got = end - pos
+        view[:got] = self._view[pos:end]
+        self._pos = self._end = 0
+        while got < numbytes:
+            missing = numbytes - got
+            if missing >= self.bufsize:
+                count = self._readinto(view[got:])
+            else:
+                count = self._readinto(self._view)
+            if not count:
+                raise EOFError("expected %d bytes, got %d" %(numbytes, got))
+            if missing >= self.bufsize:
+                got += count
+            else:
+                take = min(count, missing)
+                view[got:got+take] = self._view[:take]
+                self._pos, self._end = take, count
+                got += take
+        return bytes(result)
+
 class Popen2IO:
     error = (IOError, OSError, EOFError)
 
@@ -353,6 +474,21 @@ class Popen2IO:
         self._read = getattr(infile, "buffer", infile).read
         self._write = getattr(outfile, "buffer", outfile).write
         self.execmodel = execmodel
+        # writev() may need several system calls for one message,
+        # messages sent from different threads must not interleave
+        self._writelock = execmodel.Lock()
+        # io module streams can return what is available without
+        # blocking for more, which allows for buffering ahead
+        readinto = getattr(getattr(infile, "buffer", infile), "readinto1", None)
+        if readinto is not None and HAS_MEMORYVIEW:
+            self.read = ReadBuffer(readinto).read
+        # os.writev would block the whole process with green threads
+        self._writev_fd = None
+        if hasattr(os, 'writev') and execmodel.backend == "thread":
+            try:
+                self._writev_fd = outfile.fileno()
+            except (AttributeError, IOError, ValueError):
+                pass
 
     def read(self, numbytes):
         """Read exactly 'numbytes' bytes from the pipe. """
@@ -368,8 +504,19 @@ class Popen2IO:
     def write(self, data):
         """write out all data bytes. """
         assert isinstance(data, bytes)
-        self._write(data)
-        self.outfile.flush()
+        with self._writelock:
+            self._write(data)
+            self.outfile.flush()
+
+    def writev(self, buffers):
+        """write out all bytes of the given buffers without joining them. """
+        fd = self._writev_fd
+        if fd is None:
+            self.write(bytes().join(buffers))
+        else:
+            # write() always flushes, so there is nothing buffered
+            with self._writelock:
+                write_buffers(lambda bufs: os.writev(fd, bufs), buffers)
 
     def close_read(self):
         self.infile.close()
@@ -377,6 +524,9 @@ class Popen2IO:
     def close_write(self):
         self.outfile.close()
 
+# set in the message code of frames with a zlib compressed payload
+COMPRESSED_FLAG = 0x40
+
 class Message:
     """ encapsulates Messages and their wire protocol. """
     _types = []
@@ -386,32 +536,315 @@ class Message:
         self.channelid = channelid
         self.data = data
 
+    _header = struct.Struct('!bii') # type 1, channel 4, payload 4
+
     @staticmethod
     def from_io(io):
         try:
-            header = io.read(9) # type 1, channel 4, payload 4
+            header = io.read(9)
             if not header:
                 raise EOFError("empty read")
         except EOFError:
             e = sys.exc_info()[1]
             raise EOFError('couldnt load message header, ' + e.args[0])
-        msgtype, channel, payload = struct.unpack('!bii', header)
+        msgtype, channel, payload = Message._header.unpack(header)
         return Message(msgtype, channel, io.read(payload))
 
     def to_io(self, io):
         if struct.pack is not None:
-            header = struct.pack('!bii', self.msgcode, self.channelid,
-                                 len(self.data))
-            io.write(header+self.data)
+            writev = getattr(io, 'writev', None)
+            if writev is not None:
+                writev(self.buffers())
+            else:
+                io.write(self.pack())
+
+    def buffers(self):
+        """ return header and payload for writing without a copy. """
+        header = self._header.pack(self.msgcode, self.channelid,
+                                   len(self.data))
+        return [header, self.data]
+
+    def pack(self):
+        return bytes().join(self.buffers())
 
     def received(self, gateway):
         self._types[self.msgcode](self, gateway)
 
+    def decompress(self):
+        import zlib
+        self.msgcode &= ~COMPRESSED_FLAG
+        self.data = zlib.decompress(self.data)
+
     def __repr__(self):
-        name = self._types[self.msgcode].__name__.upper()
+        name = self._types[self.msgcode & ~COMPRESSED_FLAG].__name__.upper()
         return "<Message %s channel=%s lendata=%s>" %(
                     name, self.channelid, len(self.data))
 
+class CoalescingWriter(object):
+    """ send queue which is drained by a dedicated writer thread.
+
+        All messages queued while the writer is busy get coalesced
+        into a single io.writev() or io.write() call.  After picking up a message
+        the writer waits up to ``delay`` seconds for more messages
+        unless ``maxbytes`` bytes are already pending.
+
+        Messages in PRIORITY_MESSAGES are sent ahead of queued bulk
+        messages unless bulk messages for (or referencing) their
+        channel are still queued, which keeps per-channel ordering.
+
+        If a write fails the writer stops and calls ``onerror`` with
+        the ids of the channels whose messages were not (completely)
+        sent, i.e. those of the failed write and of all queued ones.
+    """
+    def __init__(self, io, execmodel, delay=0.0, maxbytes=65536,
+                 onerror=None):
+        self._io = io
+        self.execmodel = execmodel
+        self.delay = delay
+        self.maxbytes = maxbytes
+        self.onerror = onerror
+        # every queued message puts a token into _queue, the writer
+        # thread then takes the next message from the priority lane
+        # if there is one and from the bulk lane otherwise
+        self._queue = execmodel.queue.Queue()
+        self._lock = execmodel.Lock()
+        self._priority = deque()
+        self._bulk = deque()
+        self._pending = {}  # channelid -> number of queued bulk messages
+        self._finished = execmodel.Event()
+        self._closed = False
+        self._error = None
+        execmodel.start(self._thread_writer)
+
+    def put(self, message, refs=()):
+        """ queue message for sending, raise IOError if the writer
+        is closed or a previous write failed.  ``refs`` are the ids
+        of channels which are serialized in the message data. """
+        with self._lock:
+            if self._error is not None:
+                raise IOError("writer failed: %s" % (self._error,))
+            if self._closed:
+                raise IOError("writer is closed")
+            msgcode = message.msgcode & ~COMPRESSED_FLAG
+            channelid = message.channelid
+            if (msgcode in PRIORITY_MESSAGES and channelid and
+                    channelid not in self._pending):
+                self._priority.append((message, (channelid,)))
+            else:
+                keys = (channelid,) + tuple(refs)
+                for key in keys:
+                    self._pending[key] = self._pending.get(key, 0) + 1
+                self._bulk.append((message, keys))
+            self._queue.put(True)
+
+    def _pop(self):
+        # return the next message and the ids of its channels
+        with self._lock:
+            if self._priority:
+                return self._priority.popleft()
+            message, keys = self._bulk.popleft()
+            pending = self._pending
+            for key in keys:
+                pending[key] -= 1
+                if not pending[key]:
+                    del pending[key]
+            return message, keys
+
+    def close(self, timeout=None):
+        """ flush all pending messages and stop the writer thread,
+        return False if it did not finish within ``timeout`` seconds. """
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+        return self._finished.wait(timeout)
+
+    def _collect(self, item, ids):
+        # return the packed data of the (message, keys) item and of all
+        # messages which are queued or arrive within the delay and whether
+        # we should stop, add the ids of their channels to ids
+        Empty = self.execmodel.queue.Empty
+        message, keys = item
+        ids.update(keys)
+        chunks = message.buffers()
+        size = len(chunks[1]) + 9
+        deadline = time.time() + self.delay
+        while size < self.maxbytes:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    token = self._queue.get(timeout=remaining)
+                else:
+                    token = self._queue.get(block=False)
+            except Empty:
+                break
+            if token is None:
+                return chunks, True
+            message, keys = self._pop()
+            ids.update(keys)
+            chunks.extend(message.buffers())
+            size += len(message.data) + 9
+        return chunks, False
+
+    def _thread_writer(self):
+        stop = False
+        ids = set()
+        try:
+            while not stop:
+                if self._queue.get() is None:
+                    break
+                ids.clear()
+                chunks, stop = self._collect(self._pop(), ids)
+                writev = getattr(self._io, 'writev', None)
+                if writev is not None:
+                    writev(chunks)
+                else:
+                    self._io.write(bytes().join(chunks))
+        except Exception:
+            error = sys.exc_info()[1]
+            trace("[writer-thread] write failed: %s" % (error,))
+            with self._lock:
+                self._error = error
+                self._closed = True
+                for message, keys in self._priority:
+                    ids.update(keys)
+                for message, keys in self._bulk:
+                    ids.update(keys)
+                self._priority.clear()
+                self._bulk.clear()
+                self._pending.clear()
+            ids.discard(0)
+            try:
+                if self.onerror is not None:
+                    self.onerror(sorted(ids), error)
+            finally:
+                self._finished.set()
+        else:
+            self._finished.set()
+
+def parse_coalesce_spec(value):
+    """ return (delay, maxbytes) for a ``coalesce=DELAY[:MAXBYTES]``
+    gateway specification value. """
+    delay, maxbytes = 0.0, 65536
+    if value is not True:
+        parts = str(value).split(":")
+        if parts[0]:
+            delay = float(parts[0])
+        if len(parts) > 1:
+            maxbytes = int(parts[1])
+    return delay, maxbytes
+
+class Compressor(object):
+    """ zlib compression of message payloads of at least ``threshold``
+        bytes.  If a payload does not shrink by at least 10 percent
+        the compressor assumes incompressible data and skips a doubling
+        number (up to 64) of subsequent payloads before trying again.
+    """
+    threshold = 1024
+    maxskip = 64
+
+    def __init__(self, level):
+        import zlib
+        self._compress = zlib.compress
+        self.level = level
+        self._skip = self._backoff = 0
+
+    def compress(self, data):
+        """ return compressed data or None if data should be sent as is. """
+        if len(data) < self.threshold:
+            return None
+        if self._skip:
+            self._skip -= 1
+            return None
+        compressed = self._compress(data, self.level)
+        if len(compressed) * 10 > len(data) * 9:
+            self._backoff = min(self._backoff * 2 or 1, self.maxskip)
+            self._skip = self._backoff
+            return None
+        self._backoff = 0
+        return compressed
+
+def parse_compress_spec(value):
+    """ return the zlib level for a ``compress=zlib[:LEVEL]``
+    gateway specification value. """
+    if value is True:
+        return 1
+    method, _, level = str(value).partition(":")
+    if method != "zlib":
+        raise ValueError("unsupported compression method %r" % (method,))
+    if not level:
+        return 1
+    level = int(level)
+    if not 0 <= level <= 9:
+        raise ValueError("zlib compression level must be 0-9")
+    return level
+
+# the number of remote_exec sources whose code a slave keeps compiled
+CODE_CACHE_SIZE = 128
+
+class CodeCache(object):
+    """ least recently used cache of the code of remote_exec sources.
+
+        Slaves keep the code for the keys of the sources, masters keep
+        a cache of the same size for just the keys.  Both sides see
+        the same sequence of lookups so that the master knows when
+        sending the key suffices.
+    """
+    def __init__(self, size=CODE_CACHE_SIZE):
+        self.size = size
+        self._entries = {}
+        self._order = []  # least recently used key first
+
+    def __contains__(self, key):
+        """ return True if key is cached without marking it as used. """
+        return key in self._entries
+
+    def get(self, key):
+        """ return the entry for key or None and mark it as used. """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._order.remove(key)
+            self._order.append(key)
+        return entry
+
+    def put(self, key, entry):
+        self._entries[key] = entry
+        self._order.append(key)
+        if len(self._order) > self.size:
+            del self._entries[self._order.pop(0)]
+
+class SessionExecutor(object):
+    """ runs the remote_exec tasks of a session one after the other
+        in the order they were received, so that each execution sees
+        its own ``channel`` in the shared namespace.
+    """
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.namespace = {'__name__': '__channelexec__'}
+        self._lock = gateway.execmodel.Lock()
+        self._pending = []
+        self._running = False
+
+    def schedule(self, channel, sourcetask):
+        # executes in receiver thread
+        item = (channel, sourcetask + (self.namespace,))
+        with self._lock:
+            if self._running:
+                self._pending.append(item)
+                return
+            self._running = True
+        self.gateway._execpool.spawn(self._execute, item)
+
+    def _execute(self, item):
+        while item is not None:
+            self.gateway.executetask(item)
+            with self._lock:
+                if self._pending:
+                    item = self._pending.pop(0)
+                else:
+                    item = None
+                    self._running = False
+
 class GatewayReceivedTerminate(Exception):
     """ Receiverthread got termination message. """
 
@@ -424,7 +857,7 @@ def _setupmessages():
              'execmodel': gateway.execmodel.backend,
         }
         gateway._send(Message.CHANNEL_DATA, message.channelid,
-                      dumps_internal(d))
+                      gateway._dumps(d))
         gateway._send(Message.CHANNEL_CLOSE, message.channelid)
 
     def channel_exec(message, gateway):
@@ -434,6 +867,10 @@ def _setupmessages():
     def channel_data(message, gateway):
         gateway._channelfactory._local_receive(message.channelid, message.data)
 
+    def channel_data_multi(message, gateway):
+        gateway._channelfactory._local_receive(message.channelid,
+                                               message.data, many=True)
+
     def channel_close(message, gateway):
         gateway._channelfactory._local_close(message.channelid)
 
@@ -444,20 +881,53 @@ def _setupmessages():
     def channel_last_message(message, gateway):
         gateway._channelfactory._local_close(message.channelid, sendonly=True)
 
+    def channel_large_data(message, gateway):
+        gateway._channelfactory._local_receive_large(message.channelid,
+                                                     message.data)
+
     def gateway_terminate(message, gateway):
         raise GatewayReceivedTerminate(gateway)
 
+    def channel_credit(message, gateway):
+        gateway._channelfactory._local_credit(message.channelid,
+                                              loads_internal(message.data))
+
+    def gateway_hello(message, gateway):
+        gateway._set_format(*loads_internal(message.data))
+
+    def session_close(message, gateway):
+        # the channelid field carries the id of the session
+        gateway._sessions.pop(message.channelid, None)
+
+    def channel_pickle(message, gateway):
+        gateway._channelfactory._local_receive(message.channelid,
+                                               message.data,
+                                               loads=loads_pickled,
+                                               pickled=True)
+
     def reconfigure(message, gateway):
         if message.channelid == 0:
             target = gateway
         else:
             target = gateway._channelfactory.new(message.channelid)
-        target._strconfig = loads_internal(message.data, gateway)
+        config = loads_internal(message.data, gateway)
+        target._strconfig = config[:2]
+        if len(config) > 2:
+            # only the master side decides to accept pickled items
+            if not isinstance(gateway, SlaveGateway):
+                gateway._trace("ignoring codec %r of the other side" %
+                               (config[2],))
+            elif target is gateway:
+                gateway._codec = config[2]
+            else:
+                target._setcodec(config[2])
 
     types = [
         status, reconfigure, gateway_terminate,
         channel_exec, channel_data, channel_close,
         channel_close_error, channel_last_message,
+        channel_large_data, channel_credit, channel_data_multi,
+        gateway_hello, channel_pickle, session_close,
     ]
     for i, handler in enumerate(types):
         Message._types.append(handler)
@@ -465,6 +935,13 @@ def _setupmessages():
 
 _setupmessages()
 
+# messages which a CoalescingWriter may send ahead of channel data
+PRIORITY_MESSAGES = frozenset([
+    Message.STATUS, Message.RECONFIGURE, Message.CHANNEL_CLOSE,
+    Message.CHANNEL_CLOSE_ERROR, Message.CHANNEL_LAST_MESSAGE,
+    Message.CHANNEL_CREDIT,
+])
+
 def geterrortext(excinfo,
     format_exception=traceback.format_exception, sysex=sysex):
     try:
@@ -501,6 +978,30 @@ class TimeoutError(IOError):
 
 NO_ENDMARKER_WANTED = object()
 
+# bytes and text items longer than this are sent as a sequence of
+# CHANNEL_LARGE_DATA frames of at most this size
+LARGE_ITEM_SIZE = 8 * 1024 * 1024
+
+# bytearray, memoryview, array.array and numpy ndarray items larger
+# than this are sent as CHANNEL_LARGE_DATA frames straight from their
+# memory instead of being serialized
+LARGE_BUFFER_SIZE = 1024 * 1024
+
+# send_many() packs items into CHANNEL_DATA_MULTI messages of about this size
+MULTI_DATA_SIZE = 64 * 1024
+
+# with a CoalescingWriter, items are sent in chunks of this size
+# so that priority messages do not wait for large frames
+WRITER_CHUNK_SIZE = 256 * 1024
+
+# seconds a closing gateway waits for its CoalescingWriter to flush
+# before closing the write side under it
+WRITER_CLOSE_TIMEOUT = 10.0
+
+# the names of the codecs for channel items, "execnet" is the serializer
+# of this module and "pickle5" pickle protocol 5 with out-of-band buffers
+CODECS = ("execnet", "pickle5")
+
 class Channel(object):
     """Communication channel between two Python Interpreter execution points."""
     RemoteError = RemoteError
@@ -513,8 +1014,16 @@ class Channel(object):
         self.gateway = gateway
         #XXX: defaults copied from Unserializer
         self._strconfig = getattr(gateway, '_strconfig', (True, False))
+        self._codec = getattr(gateway, '_codec', "execnet")
         self.id = id
         self._items = self.gateway.execmodel.queue.Queue()
+        self._largesendlock = self.gateway.execmodel.Lock()
+        # flow control: the receiving side sets a window and hands out
+        # credits, the sending side spends one credit per item.  The
+        # window of the receiving side is kept by the channel factory.
+        self._creditlock = self.gateway.execmodel.Lock()
+        self._creditevent = self.gateway.execmodel.Event()
+        self._credits = None
         self._closed = False
         self._receiveclosed = self.gateway.execmodel.Event()
         self._remoteerrors = []
@@ -547,6 +1056,7 @@ class Channel(object):
                             callback,
                             endmarker,
                             self._strconfig,
+                            self._codec,
                         )
                     break
                 else:
@@ -557,6 +1067,7 @@ class Channel(object):
                         break
                     else:
                         callback(olditem)
+                        self.gateway._channelfactory._item_consumed(self.id)
 
     def __repr__(self):
         flag = self.isclosed() and "closed" or "open"
@@ -641,7 +1152,7 @@ class Channel(object):
                 put = self.gateway._send
                 if error is not None:
                     put(Message.CHANNEL_CLOSE_ERROR, self.id,
-                        dumps_internal(error))
+                        self.gateway._dumps(error))
                 else:
                     put(Message.CHANNEL_CLOSE, self.id)
                 self._trace("sent channel close message")
@@ -652,6 +1163,7 @@ class Channel(object):
             queue = self._items
             if queue is not None:
                 queue.put(ENDMARKER)
+            self._creditevent.set()
             self.gateway._channelfactory._no_longer_opened(self.id)
 
     def waitclose(self, timeout=None):
@@ -672,16 +1184,214 @@ class Channel(object):
         if error:
             raise error
 
-    def send(self, item):
+    def setwindow(self, size):
+        """ limit the number of items the other side may send
+        ahead of what was received here to ``size``.  Once that
+        many items are in transit or queued, ``send()`` on the other
+        side blocks until items are received or handled by the callback.
+        Call this after the other side knows the channel but before
+        it starts sending, items sent earlier are not accounted for.
+        The window can only be set once.
+        """
+        if size < 1:
+            raise ValueError("window size must be positive, got %r" %(size,))
+        if not self.gateway._channelfactory._setwindow(self.id, size):
+            raise ValueError("%r has a window already" %(self,))
+        self.gateway._send(Message.CHANNEL_CREDIT, self.id,
+                           self.gateway._dumps(size))
+
+    def _take_credit(self):
+        with self._creditlock:
+            # without a window from the other side, or when no more
+            # credits can be received, there is no flow control.  It
+            # stays for a "sendonly" channel, the other side then
+            # receives with a callback.
+            if (self._credits is None or self._closed or
+                    self.gateway._channelfactory.finished):
+                return True
+            if self._credits > 0:
+                self._credits -= 1
+                return True
+            self._creditevent.clear()
+            return False
+
+    def _acquire_credit(self, timeout):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not self._take_credit():
+            if timeout is None:
+                self._creditevent.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._creditevent.wait(remaining):
+                    raise self.TimeoutError(
+                        "no send credit after %r seconds" %(timeout,))
+            if self.isclosed():
+                raise IOError("cannot send to %r" %(self,))
+
+    def send(self, item, timeout=None):
         """sends the given item to the other side of the channel,
-        possibly blocking if the sender queue is full.
-        The item must be a simple python type and will be
-        copied to the other side by value.  IOError is
+        possibly blocking if the other side set a window with
+        ``setwindow()`` and has not received enough items yet.
+        timeout: None [default] blocked waiting.  A positive number
+        indicates the number of seconds after which a channel.TimeoutError
+        exception will be raised if the item could not be sent.
+        The item must be a simple python type, a bytearray,
+        memoryview, numeric array.array or numpy ndarray and will
+        be copied to the other side by value.  IOError is
         raised if the write pipe was prematurely closed.
+        Bytes or text items of any size may be sent, large
+        ones are transferred in chunks.
         """
         if self.isclosed():
             raise IOError("cannot send to %r" %(self,))
-        self.gateway._send(Message.CHANNEL_DATA, self.id, dumps_internal(item))
+        # serialize before taking a credit which a DumpError would lose
+        if self._codec == "pickle5":
+            parts = self._pickled_parts(item)
+            self._acquire_credit(timeout)
+            self._send_pickled(parts)
+            return
+        large = self._large_parts(item)
+        if large is not None:
+            self._acquire_credit(timeout)
+            self._send_chunks(*large)
+            return
+        serializer = self.gateway._serializer()
+        data = serializer.save(item)
+        self._acquire_credit(timeout)
+        self._send_data(data, serializer.channelids)
+
+    def send_many(self, items, timeout=None):
+        """sends the items of the given iterable to the other side,
+        packing as many of them as possible into each message.  The
+        other side receives them one by one as if they were sent with
+        ``send()``.  timeout applies to each item as with ``send()``.
+        """
+        if self.isclosed():
+            raise IOError("cannot send to %r" %(self,))
+        if self._codec == "pickle5":
+            for item in items:
+                self.send(item, timeout)
+            return
+        batch = []
+        refs = []
+        size = 0
+        try:
+            for item in items:
+                # serialize before taking the credit of the item
+                large = self._large_parts(item)
+                if large is None:
+                    serializer = self.gateway._serializer()
+                    data = serializer.save(item)
+                if not self._take_credit():
+                    # let the other side receive what we have got so far
+                    self._send_batch(batch, refs)
+                    size = 0
+                    self._acquire_credit(timeout)
+                if large is not None:
+                    self._send_batch(batch, refs)
+                    size = 0
+                    self._send_chunks(*large)
+                    continue
+                batch.append(data)
+                refs.extend(serializer.channelids)
+                size += len(data)
+                if size >= MULTI_DATA_SIZE:
+                    self._send_batch(batch, refs)
+                    size = 0
+        finally:
+            # items batched before an error are sent as with send(),
+            # their credits are taken already
+            self._send_batch(batch, refs)
+
+    def _send_batch(self, batch, refs):
+        # the batch is emptied first so that it is not sent again
+        # after a failing send
+        items, batch[:] = batch[:], []
+        itemrefs, refs[:] = refs[:], []
+        if len(items) == 1 or "multi" not in self.gateway._features:
+            for data in items:
+                self._send_data(data, itemrefs)
+        elif items:
+            self.gateway._send(Message.CHANNEL_DATA_MULTI, self.id,
+                               bytes().join(items), itemrefs)
+
+    def _send_data(self, data, refs):
+        if (self.gateway._writer is not None and
+                len(data) > WRITER_CHUNK_SIZE):
+            self._send_chunks("data", data, refs)
+        else:
+            self.gateway._send(Message.CHANNEL_DATA, self.id, data, refs)
+
+    def _large_parts(self, item):
+        """ return kind and data for sending the item in chunks
+        or None if it is to be serialized. """
+        if "large" not in self.gateway._features:
+            return None
+        if type(item) in (bytes, unicode):
+            if len(item) <= LARGE_ITEM_SIZE:
+                return None
+            # the kinds correspond to the Unserializer string loaders
+            if isinstance(item, bytes):
+                return ISPY3 and "bytes" or "py2string", item
+            try:
+                item = item.encode("utf-8")
+            except UnicodeEncodeError:
+                raise DumpError("strings must be utf-8 encodable")
+            return ISPY3 and "py3string" or "unicode", item
+        if not ISPY3:
+            return None
+        parts = _buffer_parts(item)
+        if parts is None or len(parts[1]) <= LARGE_BUFFER_SIZE:
+            return None
+        kind, data = parts
+        if self.gateway._writer is not None:
+            # the writer sends later and the item may change meanwhile
+            data = bytes(data)
+        return kind, data
+
+    def _send_chunks(self, kind, data, refs=()):
+        self._send_parts(kind, [data], refs)
+
+    def _send_parts(self, kind, parts, refs=()):
+        # the parts are sent as one item whose data is their concatenation
+        if ISPY3:
+            parts = [memoryview(data) for data in parts]  # without copying
+        chunksize = LARGE_ITEM_SIZE
+        if self.gateway._writer is not None:
+            chunksize = WRITER_CHUNK_SIZE
+        send = self.gateway._send
+        with self._largesendlock:
+            send(Message.CHANNEL_LARGE_DATA, self.id,
+                 self.gateway._dumps((kind, sum(map(len, parts)))))
+            for data in parts:
+                for i in range(0, len(data), chunksize):
+                    send(Message.CHANNEL_LARGE_DATA, self.id,
+                         data[i:i+chunksize], refs)
+
+    def _pickled_parts(self, item):
+        # the pickle data followed by the raw out-of-band buffers
+        import pickle
+        buffers = []
+        try:
+            data = pickle.dumps(item, protocol=5,
+                                buffer_callback=buffers.append)
+        except Exception:
+            raise DumpError("can't pickle %r: %s" % (
+                            type(item), sys.exc_info()[1]))
+        parts = [data] + [buffer.raw() for buffer in buffers]
+        if buffers and self.gateway._writer is not None:
+            # the writer sends later and the buffers may change meanwhile
+            parts = [data] + [part.tobytes() for part in parts[1:]]
+        return parts
+
+    def _send_pickled(self, parts):
+        if len(parts) == 1 and (self.gateway._writer is None or
+                                len(parts[0]) <= WRITER_CHUNK_SIZE):
+            self.gateway._send(Message.CHANNEL_PICKLE, self.id, parts[0])
+            return
+        # out-of-band buffers are sent straight from their memory
+        self._send_parts(("pickle5", [len(part) for part in parts]), parts)
 
     def receive(self, timeout=None):
         """receive a data item that was sent from the other side.
@@ -703,6 +1413,7 @@ class Channel(object):
             itemqueue.put(x)  # for other receivers
             raise self._getremoteerror() or EOFError()
         else:
+            self.gateway._channelfactory._item_consumed(self.id)
             return x
 
     def __iter__(self):
@@ -716,16 +1427,50 @@ class Channel(object):
     __next__ = next
 
 
-    def reconfigure(self, py2str_as_py3str=True, py3str_as_py2str=False):
+    def reconfigure(self, py2str_as_py3str=True, py3str_as_py2str=False,
+                    codec=None):
         """
         set the string coercion for this channel
         the default is to try to convert py2 str as py3 str,
-        but not to try and convert py3 str to py2 str
+        but not to try and convert py3 str to py2 str.
+        codec "pickle5" makes both sides of the channel send items
+        with pickle protocol 5, passing out-of-band buffers to the
+        transport without copying, "execnet" switches back to the
+        default serializer.  Pickled items are only accepted if the
+        master side chose the codec, it must trust the other side.
         """
         self._strconfig = (py2str_as_py3str, py3str_as_py2str)
-        data = dumps_internal(self._strconfig)
+        config = self._strconfig
+        if codec is not None:
+            _check_codec(self.gateway, codec)
+            self._setcodec(codec)
+            config += (codec,)
+        data = self.gateway._dumps(config)
         self.gateway._send(Message.RECONFIGURE, self.id, data=data)
 
+    def _setcodec(self, codec):
+        # a registered callback keeps the codec for the channel id,
+        # the channel object may be gone when items arrive
+        with self.gateway._receivelock:
+            self._codec = codec
+            _callbacks = self.gateway._channelfactory._callbacks
+            entry = _callbacks.get(self.id)
+            if entry is not None:
+                _callbacks[self.id] = entry[:3] + (codec,)
+
+def _refused_pickle_text(id):
+    return ("pickled item for channel %d which did not choose "
+            "the pickle5 codec" % (id,))
+
+def _check_codec(gateway, codec):
+    if codec not in CODECS:
+        raise ValueError("unknown codec %r" % (codec,))
+    if isinstance(gateway, SlaveGateway):
+        raise ValueError("the codec can only be chosen on the master side")
+    if codec == "pickle5" and PICKLE5_FEATURE not in gateway._features:
+        raise ValueError("codec pickle5 needs Python 3.8 or later "
+                         "in the same version on both sides")
+
 ENDMARKER = object()
 INTERRUPT_TEXT = "keyboard-interrupted"
 
@@ -733,6 +1478,11 @@ class ChannelFactory(object):
     def __init__(self, gateway, startcount=1):
         self._channels = weakref.WeakValueDictionary()
         self._callbacks = {}
+        self._largeitems = {}
+        # receive window of channels with flow control,
+        # id -> [window size, items consumed since the last credit]
+        self._windows = {}
+        self._windowlock = gateway.execmodel.Lock()
         self._writelock = gateway.execmodel.Lock()
         self.gateway = gateway
         self.count = startcount
@@ -756,16 +1506,46 @@ class ChannelFactory(object):
     def channels(self):
         return self._list(self._channels.values())
 
+    def _setwindow(self, id, size):
+        with self._windowlock:
+            if id in self._windows:
+                return False
+            self._windows[id] = [size, 0]
+            return True
+
+    def _item_consumed(self, id):
+        # give back credits in batches of half the window, this
+        # works without the channel object for callbacks
+        if id not in self._windows:
+            return
+        with self._windowlock:
+            state = self._windows.get(id)
+            if state is None:
+                return
+            state[1] += 1
+            if state[1] * 2 < state[0]:
+                return
+            credits = state[1]
+            state[1] = 0
+        try:
+            self.gateway._send(Message.CHANNEL_CREDIT, id,
+                               self.gateway._dumps(credits))
+        except (IOError, ValueError):
+            pass
+
     #
     # internal methods, called from the receiver thread
     #
-    def _no_longer_opened(self, id):
-        try:
-            del self._channels[id]
-        except KeyError:
-            pass
+    def _no_longer_opened(self, id, keepchannel=False):
+        if not keepchannel:
+            try:
+                del self._channels[id]
+            except KeyError:
+                pass
+        self._largeitems.pop(id, None)
+        self._windows.pop(id, None)
         try:
-            callback, endmarker, strconfig = self._callbacks.pop(id)
+            callback, endmarker, strconfig, codec = self._callbacks.pop(id)
         except KeyError:
             pass
         else:
@@ -786,39 +1566,89 @@ class ChannelFactory(object):
             queue = channel._items
             if queue is not None:
                 queue.put(ENDMARKER)
-            self._no_longer_opened(id)
+            # a "sendonly" channel still receives the credits for the
+            # window of the other side, which receives with a callback
+            self._no_longer_opened(id, keepchannel=sendonly and
+                                   channel._credits is not None and
+                                   not self.finished)
             if not sendonly: # otherwise #--> "sendonly"
                 channel._closed = True          # --> "closed"
             channel._receiveclosed.set()
+            channel._creditevent.set()
 
-    def _local_receive(self, id, data):
+    def _local_receive(self, id, data, loads=None, many=False, pickled=False):
         # executes in receiver thread
+        if loads is None:
+            loads = many and loads_many_internal or loads_internal
         channel = self._channels.get(id)
         try:
-            callback, endmarker, strconfig = self._callbacks[id]
+            callback, endmarker, strconfig, codec = self._callbacks[id]
         except KeyError:
             queue = channel and channel._items
             if queue is None:
                 pass    # drop data
+            elif pickled and channel._codec != "pickle5":
+                self._local_error(id, _refused_pickle_text(id))
+            elif many:
+                for item in loads(data, channel):
+                    queue.put(item)
             else:
-                item = loads_internal(data, channel)
+                item = loads(data, channel)
                 queue.put(item)
         else:
             try:
-                data = loads_internal(data, channel, strconfig)
-                callback(data)   # even if channel may be already closed
+                if pickled and codec != "pickle5":
+                    raise DataFormatError(_refused_pickle_text(id))
+                items = loads(data, channel, strconfig)
+                if not many:
+                    items = [items]
+                for item in items:
+                    callback(item)   # even if channel may be already closed
+                    self._item_consumed(id)
             except Exception:
                 excinfo = sys.exc_info()
                 self.gateway._trace("exception during callback: %s" %
                                     excinfo[1])
-                errortext = self.gateway._geterrortext(excinfo)
-                self.gateway._send(Message.CHANNEL_CLOSE_ERROR,
-                                   id, dumps_internal(errortext))
-                self._local_close(id, errortext)
+                self._local_error(id, self.gateway._geterrortext(excinfo))
+
+    def _local_error(self, id, errortext):
+        # close the channel on both sides because of a receiving error
+        self.gateway._send(Message.CHANNEL_CLOSE_ERROR,
+                           id, self.gateway._dumps(errortext))
+        self._local_close(id, RemoteError(errortext))
+
+    def _local_credit(self, id, credits):
+        # executes in receiver thread
+        channel = self._channels.get(id)
+        if channel is None:
+            return  # nobody can send anymore
+        with channel._creditlock:
+            channel._credits = (channel._credits or 0) + credits
+            channel._creditevent.set()
+
+    def _local_receive_large(self, id, data):
+        # executes in receiver thread, the first frame tells
+        # kind and size of the item, the following ones carry its data
+        state = self._largeitems.get(id)
+        if state is None:
+            kind, size = loads_internal(data)
+            self._largeitems[id] = [kind, bytearray(size), 0]
+            return
+        kind, buf, pos = state
+        end = pos + len(data)
+        buf[pos:end] = data
+        if end < len(buf):
+            state[2] = end
+        else:
+            del self._largeitems[id]
+            pickled = isinstance(kind, tuple) and kind[0] == "pickle5"
+            self._local_receive(id, (kind, buf), loads=loads_large_internal,
+                                pickled=pickled)
 
     def _finished_receiving(self):
         with self._writelock:
             self.finished = True
+        self._largeitems.clear()
         for id in self._list(self._channels):
             self._local_close(id, sendonly=True)
         for id in self._list(self._callbacks):
@@ -893,16 +1723,39 @@ class BaseGateway(object):
         self.id = id
         self._strconfig = (Unserializer.py2str_as_py3str,
                            Unserializer.py3str_as_py2str)
+        self._codec = "execnet"
+        self._codecache = CodeCache()
+        self._sessions = {}  # session id -> SessionExecutor
         self._channelfactory = ChannelFactory(self, _startcount)
         self._receivelock = self.execmodel.RLock()
         # globals may be NONE at process-termination
         self.__trace = trace
         self._geterrortext = geterrortext
         self._receivepool = self.execmodel.WorkerPool()
+        self._writer = None
+        self._compressor = None
+        # peers which did not negotiate only understand format version 1
+        self._format_version = 1
+        self._features = frozenset()
 
     def _trace(self, *msg):
         self.__trace(self.id, *msg)
 
+    def _set_format(self, version, features):
+        """ use the format version and features agreed on with the
+        other side for sending. """
+        self._format_version = version
+        self._features = frozenset(features)
+        self._trace("using format version %s, features %s" % (
+                    version, ", ".join(sorted(self._features))))
+
+    def _serializer(self):
+        return _Serializer(version=self._format_version,
+                           features=self._features)
+
+    def _dumps(self, obj):
+        return self._serializer().save(obj)
+
     def _initreceive(self):
         self._receivepool.spawn(self._thread_receiver)
 
@@ -915,6 +1768,8 @@ class BaseGateway(object):
         try:
             while 1:
                 msg = Message.from_io(io)
+                if msg.msgcode & COMPRESSED_FLAG:
+                    msg.decompress()
                 log("received", msg)
                 with self._receivelock:
                     msg.received(self)
@@ -934,18 +1789,59 @@ class BaseGateway(object):
         log('closing read')
         self._io.close_read()
         log('closing write')
-        self._io.close_write()
+        self._close_write()
         log('terminating our receive pseudo pool')
         self._receivepool.trigger_shutdown()
 
     def _terminate_execution(self):
         pass
 
-    def _send(self, msgcode, channelid=0, data=bytes()):
+    def _start_writer(self, coalesce):
+        """ route all sending through a CoalescingWriter configured
+        from the ``coalesce=DELAY[:MAXBYTES]`` spec value. """
+        delay, maxbytes = parse_coalesce_spec(coalesce)
+        self._writer = CoalescingWriter(self._io, self.execmodel,
+                                        delay=delay, maxbytes=maxbytes,
+                                        onerror=self._writer_failed)
+
+    def _writer_failed(self, ids, error):
+        # executes in the writer thread: close the channels whose
+        # messages were lost with an error instead of leaving them open
+        self._trace("writer failed, closing channels", ids)
+        text = "could not send to the other side: %s" % (error,)
+        factory = self._channelfactory
+        with self._receivelock:
+            for id in ids:
+                remoteerror = None
+                if id in factory._channels:
+                    remoteerror = RemoteError(text)
+                factory._local_close(id, remoteerror)
+
+    def _start_compression(self, compress):
+        """ compress larger payloads as configured by the
+        ``compress=zlib[:LEVEL]`` spec value. """
+        self._compressor = Compressor(parse_compress_spec(compress))
+
+    def _close_write(self):
+        if self._writer is not None:
+            if not self._writer.close(timeout=WRITER_CLOSE_TIMEOUT):
+                self._trace("writer did not finish, closing write anyway")
+        self._io.close_write()
+
+    def _send(self, msgcode, channelid=0, data=bytes(), refs=()):
+        if self._compressor is not None:
+            compressed = self._compressor.compress(data)
+            if compressed is not None:
+                msgcode |= COMPRESSED_FLAG
+                data = compressed
         message = Message(msgcode, channelid, data)
         try:
-            message.to_io(self._io)
-            self._trace('sent', message)
+            if self._writer is not None:
+                self._writer.put(message, refs)
+                self._trace('queued', message)
+            else:
+                message.to_io(self._io)
+                self._trace('sent', message)
         except (IOError, ValueError):
             e = sys.exc_info()[1]
             self._trace('failed to send', message, e)
@@ -973,8 +1869,39 @@ class SlaveGateway(BaseGateway):
 
     def _local_schedulexec(self, channel, sourcetask):
         sourcetask = loads_internal(sourcetask)
+        if len(sourcetask) > 3:
+            session = None
+            if len(sourcetask) > 5:
+                session = sourcetask[5]
+                sourcetask = sourcetask[:5]
+            sourcetask = self._cached_task(*sourcetask)
+            if sourcetask is None:
+                channel.close("code of remote_exec source is not cached")
+                return
+            if session is not None:
+                # created here to be in order with SESSION_CLOSE messages
+                executor = self._sessions.get(session)
+                if executor is None:
+                    executor = self._sessions[session] = \
+                        SessionExecutor(self)
+                executor.schedule(channel, sourcetask)
+                return
         self._execpool.spawn(self.executetask, ((channel, sourcetask)))
 
+    def _cached_task(self, source, call_name, kwargs, key, code):
+        # executes in receiver thread in the order of sending, the
+        # entry is [source, code object] with the code compiled lazily
+        entry = self._codecache.get(key)
+        if entry is None:
+            if source is None and code is None:
+                return None
+            if code is not None:
+                import marshal
+                code = marshal.loads(code)
+            entry = [source, code]
+            self._codecache.put(key, entry)
+        return entry, call_name, kwargs
+
     def _terminate_execution(self):
         # called from receiverthread
         self._trace("shutting down execution pool")
@@ -1013,7 +1940,8 @@ class SlaveGateway(BaseGateway):
 
     def executetask(self, item):
         try:
-            channel, (source, call_name, kwargs) = item
+            channel, sourcetask = item
+            source, call_name, kwargs = sourcetask[:3]
             if not ISPY3 and kwargs:
                 # some python2 versions do not accept unicode keyword params
                 # note: Unserializer generally turns py2-str to py3-str objects
@@ -1023,12 +1951,22 @@ class SlaveGateway(BaseGateway):
                         name = name.encode('ascii')
                     newkwargs[name] = value
                 kwargs = newkwargs
-            loc = {'channel' : channel, '__name__': '__channelexec__'}
+            if len(sourcetask) > 3:
+                loc = sourcetask[3]
+                loc['channel'] = channel
+            else:
+                loc = {'channel' : channel, '__name__': '__channelexec__'}
             self._trace("execution starts[%s]: %s" %
                             (channel.id, repr(source)[:50]))
             channel._executing = True
             try:
-                co = compile(source+'\n', '<remote exec>', 'exec')
+                if isinstance(source, list):
+                    if source[1] is None:
+                        source[1] = compile(source[0]+'\n', '<remote exec>',
+                                            'exec')
+                    co = source[1]
+                else:
+                    co = compile(source+'\n', '<remote exec>', 'exec')
                 do_exec(co, loc) # noqa
                 if call_name:
                     self._trace('calling %s(**%60r)' % (call_name, kwargs))
@@ -1072,175 +2010,628 @@ else:
 
 DUMPFORMAT_VERSION = bchr(1)
 
+# version of the format used between gateways, opcodes added
+# after version 1 are only written when serializing for version 2+,
+# version 3 adds packed numeric arrays, version 4 bytearrays and
+# numpy ndarrays, version 5 varint and binary big int encodings,
+# version 6 back-references to repeated strings
+INTERNAL_FORMAT_VERSION = 6
+
 FOUR_BYTE_INT_MAX = 2147483647
 
 FLOAT_FORMAT = "!d"
 FLOAT_FORMAT_SIZE = struct.calcsize(FLOAT_FORMAT)
 
+_int4_struct = struct.Struct("!i")
+_float_struct = struct.Struct(FLOAT_FORMAT)
+# an opcode followed by its argument, packed with a single call
+_op_int4_struct = struct.Struct("!ci")
+_op_float_struct = struct.Struct("!c" + FLOAT_FORMAT[1:])
+# opcode, wire typecode and item count of a packed array
+_op_array_struct = struct.Struct("!cci")
+
+# packed arrays are sent little-endian with the item sizes that the
+# struct module uses for these typecodes, array.array typecodes of the
+# same kind and size are used locally
+_ARRAY_WIRE_SIZES = {"b": 1, "B": 1, "h": 2, "H": 2, "i": 4, "I": 4,
+                     "q": 8, "Q": 8, "f": 4, "d": 8}
+
+def _build_array_typecodes():
+    to_wire = {}
+    from_wire = {}
+    for typecode in "bBhHiIlLqQfd":
+        try:
+            itemsize = array.array(typecode).itemsize
+        except ValueError: # no "q" and "Q" before Python 3.3
+            continue
+        for wirecode, size in _ARRAY_WIRE_SIZES.items():
+            if (size == itemsize and
+                    (wirecode in "fd") == (typecode in "fd") and
+                    wirecode.isupper() == typecode.isupper()):
+                to_wire[typecode] = wirecode.encode("ascii")
+                from_wire.setdefault(wirecode.encode("ascii"),
+                                     (typecode, itemsize))
+    return to_wire, from_wire
+
+_array_to_wire, _array_from_wire = _build_array_typecodes()
+
+# the smallest signed typecodes with their value ranges for packing
+# lists of ints
+_int_array_ranges = [(_array_from_wire[code][0],
+                      -2**(bits-1), 2**(bits-1)-1)
+                     for code, bits in ((b"b", 8), (b"h", 16),
+                                        (b"i", 32), (b"q", 64))
+                     if code in _array_from_wire]
+
+# from format version 5 on ints whose magnitude is below this limit
+# are written as zigzag varints of at most 2 bytes, longer varints
+# would cost more CPU time than they save bytes over INT.  Ints not
+# fitting into 4 bytes are written as two's complement bytes.
+VARINT_LIMIT = 2**13
+
+# opcode and 1 or 2 varint bytes
+_op_varint1_struct = struct.Struct("!cB")
+_op_varint2_struct = struct.Struct("!cBB")
+
+def _op_varint(op, i):
+    """ return op followed by the zigzag varint encoding of i, which
+    must be smaller than VARINT_LIMIT in magnitude. """
+    if i >= 0:
+        z = i << 1
+    else:
+        z = ((-i) << 1) - 1
+    if z < 0x80:
+        return _op_varint1_struct.pack(op, z)
+    return _op_varint2_struct.pack(op, z & 0x7f | 0x80, z >> 7)
+
+if ISPY3:
+    def _int_to_bytes(i):
+        return i.to_bytes(i.bit_length() // 8 + 1, "big", signed=True)
+
+    def _int_from_bytes(as_bytes):
+        return int.from_bytes(as_bytes, "big", signed=True)
+else:
+    def _int_to_bytes(i):
+        length = len(bin(abs(i))) // 8 + 1
+        if i < 0:
+            i += 1 << (8 * length)
+        return binascii.unhexlify("%0*x" % (2 * length, i))
+
+    def _int_from_bytes(as_bytes):
+        i = int(binascii.hexlify(as_bytes), 16)
+        if as_bytes and ord(as_bytes[0]) & 0x80:
+            i -= 1 << (8 * len(as_bytes))
+        return i
+
+# from format version 6 on str objects up to this length are memoized
+# per message, repeated ones are written as a back-reference
+MEMO_MAX_LENGTH = 64
+
+# lists shorter than this are not checked for being packable
+PACKED_LIST_MIN = 8
+
+def _packed_list(L):
+    """ return an array.array with the items of the list if they are
+    all floats or all ints that fit into 64 bits, otherwise None. """
+    types = set(map(type, L))
+    if len(types) != 1:
+        return None
+    tp = types.pop()
+    if tp is float:
+        return array.array("d", L)
+    if tp is int:
+        low, high = min(L), max(L)
+        for typecode, minimum, maximum in _int_array_ranges:
+            if minimum <= low and high <= maximum:
+                return array.array(typecode, L)
+    return None
+
+def _array_wire_type(wirecode):
+    """ return the local typecode and item size for a wire typecode. """
+    try:
+        return _array_from_wire[wirecode]
+    except KeyError:
+        raise LoadError("unknown array typecode %r" % (wirecode,))
+
+def _array_from_bytes(typecode, as_bytes):
+    arr = array.array(typecode)
+    if ISPY3:
+        arr.frombytes(as_bytes)
+    else:
+        arr.fromstring(bytes(as_bytes))
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+def _byte_view(obj):
+    """ return the contents of a buffer object as bytes, without
+    copying them if the buffer is contiguous (Python 3.3 and later). """
+    if ISPY3:
+        view = memoryview(obj)
+        # c_contiguous and cast() are new in Python 3.3
+        if sys.version_info >= (3, 3) and view.c_contiguous:
+            return view.cast("B")
+        return view.tobytes()
+    return bytes(buffer(obj))
+
+def _memoized(stack):
+    """ intern the string on top of the stack for the memo. """
+    if not stack:
+        raise LoadError("nothing to memoize")
+    s = stack[-1]
+    if type(s) is str:
+        s = stack[-1] = intern(s)
+    return s
+
+def _memo_lookup(memo, index):
+    try:
+        return memo[index]
+    except IndexError:
+        raise LoadError("string back-reference %r out of range" % (index,))
+
+def _is_ndarray(obj):
+    tp = type(obj)
+    return tp.__name__ == "ndarray" and tp.__module__ == "numpy"
+
+def _ndarray_parts(arr):
+    """ return dtype string, shape and raw data of a numpy ndarray. """
+    import numpy
+    if arr.dtype.hasobject or arr.dtype.names is not None:
+        raise DumpError("can't serialize ndarray of dtype %s" % (arr.dtype,))
+    shape = arr.shape
+    data = numpy.ascontiguousarray(arr).reshape(-1).view(numpy.uint8)
+    return arr.dtype.str, shape, _byte_view(data)
+
+def _ndarray_from_bytes(dtype, shape, as_bytes):
+    """ return a writable ndarray built from the given bytearray. """
+    try:
+        import numpy
+    except ImportError:
+        raise LoadError("can't load ndarray, numpy is not importable")
+    return numpy.frombuffer(as_bytes, dtype=numpy.dtype(dtype)).reshape(shape)
+
+def _buffer_parts(item):
+    """ return the chunk kind and raw data of a bytearray, memoryview,
+    array.array or ndarray for loads_large_internal, None for other
+    items and arrays which the serializer refuses. """
+    tp = type(item)
+    if tp is bytearray:
+        return "bytearray", _byte_view(item)
+    if HAS_MEMORYVIEW and tp is memoryview:
+        return "bytes", _byte_view(item)
+    if tp is array.array:
+        wirecode = _array_to_wire.get(item.typecode)
+        if wirecode is None:
+            return None
+        if sys.byteorder == "big":
+            item = array.array(item.typecode, item)
+            item.byteswap()
+        return ("array", wirecode), _byte_view(item)
+    if _is_ndarray(item):
+        dtype, shape, data = _ndarray_parts(item)
+        return ("ndarray", dtype, shape), data
+    return None
+
 class _Stop(Exception):
     pass
 
 class Unserializer(object):
+    """ unserializes from a bytes, bytearray or (on Python3) memoryview
+    object, or from a stream of which only the loaded item is consumed.
+    Each loader gets the data, the position after its opcode and the
+    stack and returns the position of the next opcode, ``pos`` is where
+    the next load starts.  Loaders call ``_fill`` before reading beyond
+    the end of the data, which reads more of a stream into the data,
+    and change the stack only after reading.
+    """
     num2func = {} # is filled after this class definition
     py2str_as_py3str = True # True
     py3str_as_py2str = False  # false means py2 will get unicode
+    stream = None
+    readahead = 65536
 
-    def __init__(self, stream, channel_or_gateway=None, strconfig=None):
+    def __init__(self, data, channel_or_gateway=None, strconfig=None):
         gateway = getattr(channel_or_gateway, 'gateway', channel_or_gateway)
         strconfig = getattr(channel_or_gateway, '_strconfig', strconfig)
         if strconfig:
             self.py2str_as_py3str, self.py3str_as_py2str = strconfig
-        self.stream = stream
+        if hasattr(data, "read"):
+            self.stream = data
+            if not getattr(data, "seekable", lambda: False)():
+                self.readahead = 0
+            data = bytearray()
+            self._fill = self._fill_from_stream
+        self.data = data
+        self.pos = 0
+        self._copy = type(data) is not bytes
         self.channelfactory = getattr(gateway, '_channelfactory', gateway)
 
+    def _fill(self, data, end, lookahead=1):
+        raise EOFError("expected %d bytes, got %d" % (end, len(data)))
+
+    def _fill_from_stream(self, data, end, lookahead=1):
+        # data is the bytearray of the item read so far.  At least the
+        # STOP opcode follows the data of a loader, so loaders also read
+        # the next opcode.  Opcodes, which may be STOP, are read without
+        # lookahead.  Seekable streams are read in blocks instead and
+        # load() seeks back to the end of the item.
+        end += lookahead
+        size = max(end - len(data), self.readahead)
+        while True:
+            chunk = self.stream.read(size)
+            if not chunk:
+                raise EOFError("expected %d bytes, got %d" % (end, len(data)))
+            data += chunk
+            if len(data) >= end:
+                return
+            size = end - len(data)
+
     def load(self, versioned=False):
+        if self.stream is not None:
+            del self.data[:]
+            self.pos = 0
+        data = self.data
+        pos = self.pos
         if versioned:
-            ver = self.stream.read(1)
+            if pos >= len(data):
+                try:
+                    self._fill(data, pos + 1)
+                except EOFError:
+                    pass
+            ver = data[pos:pos+1]
             if ver != DUMPFORMAT_VERSION:
                 raise LoadError("wrong dumpformat version %r" % ver)
-        self.stack = []
+            pos += 1
+        stack = []
+        self.memo = []
+        num2func = self.num2func
         try:
             while True:
-                opcode = self.stream.read(1)
-                if not opcode:
-                    raise EOFError
                 try:
-                    loader = self.num2func[opcode]
+                    loader = num2func[data[pos]]
+                except IndexError:
+                    self._fill(data, pos + 1, 0)
+                    continue
                 except KeyError:
                     raise LoadError("unkown opcode %r - "
-                        "wire protocol corruption?" % (opcode,))
-                loader(self)
+                        "wire protocol corruption?" % (data[pos:pos+1],))
+                pos = loader(self, data, pos + 1, stack)
         except _Stop:
-            if len(self.stack) != 1:
+            if len(stack) != 1:
                 raise LoadError("internal unserialization error")
-            return self.stack.pop(0)
-        else:
-            raise LoadError("didn't get STOP")
-
-    def load_none(self):
-        self.stack.append(None)
-
-    def load_true(self):
-        self.stack.append(True)
-
-    def load_false(self):
-        self.stack.append(False)
-
-    def load_int(self):
-        i = self._read_int4()
-        self.stack.append(i)
-
-    def load_longint(self):
-        s = self._read_byte_string()
-        self.stack.append(int(s))
+            if self.stream is not None and len(data) > self.pos:
+                self.stream.seek(self.pos - len(data), 1)
+            return stack.pop()
+
+    def _load_extended(self, data, pos, stack):
+        if pos >= len(data):
+            self._fill(data, pos + 1)
+        code = bytes(data[pos-1:pos+1])
+        try:
+            loader = self.num2func[code]
+        except KeyError:
+            raise LoadError("unkown opcode %r - "
+                "wire protocol corruption?" % (code,))
+        return loader(self, data, pos + 1, stack)
+
+    def load_none(self, data, pos, stack):
+        stack.append(None)
+        return pos
+
+    def load_true(self, data, pos, stack):
+        stack.append(True)
+        return pos
+
+    def load_false(self, data, pos, stack):
+        stack.append(False)
+        return pos
+
+    def load_int(self, data, pos, stack):
+        end = pos + 4
+        if end > len(data):
+            self._fill(data, end)
+        stack.append(_int4_struct.unpack_from(data, pos)[0])
+        return end
+
+    def load_longint(self, data, pos, stack):
+        s, pos = self._read_byte_string(data, pos)
+        stack.append(int(s))
+        return pos
 
     if ISPY3:
         load_long = load_int
         load_longlong = load_longint
     else:
-        def load_long(self):
-            i = self._read_int4()
-            self.stack.append(long(i))
-
-        def load_longlong(self):
-            l = self._read_byte_string()
-            self.stack.append(long(l))
-
-    def load_float(self):
-        binary = self.stream.read(FLOAT_FORMAT_SIZE)
-        self.stack.append(struct.unpack(FLOAT_FORMAT, binary)[0])
-
-    def _read_int4(self):
-        return struct.unpack("!i", self.stream.read(4))[0]
-
-    def _read_byte_string(self):
-        length = self._read_int4()
-        as_bytes = self.stream.read(length)
-        return as_bytes
-
-    def load_py3string(self):
-        as_bytes = self._read_byte_string()
+        def load_long(self, data, pos, stack):
+            stack.append(long(self._read_int4(data, pos)))
+            return pos + 4
+
+        def load_longlong(self, data, pos, stack):
+            s, pos = self._read_byte_string(data, pos)
+            stack.append(long(s))
+            return pos
+
+    def load_float(self, data, pos, stack):
+        end = pos + FLOAT_FORMAT_SIZE
+        if end > len(data):
+            self._fill(data, end)
+        stack.append(_float_struct.unpack_from(data, pos)[0])
+        return end
+
+    def _read_int4(self, data, pos):
+        if pos + 4 > len(data):
+            self._fill(data, pos + 4)
+        return _int4_struct.unpack_from(data, pos)[0]
+
+    def _read_byte_string(self, data, pos):
+        end = pos + 4
+        if end > len(data):
+            self._fill(data, end)
+        end += _int4_struct.unpack_from(data, pos)[0]
+        if end > len(data):
+            self._fill(data, end)
+        as_bytes = data[pos+4:end]
+        if self._copy:
+            as_bytes = bytes(as_bytes)
+        return as_bytes, end
+
+    def load_py3string(self, data, pos, stack):
+        as_bytes, pos = self._read_byte_string(data, pos)
         if not ISPY3 and self.py3str_as_py2str:
             # XXX Should we try to decode into latin-1?
-            self.stack.append(as_bytes)
+            stack.append(as_bytes)
         else:
-            self.stack.append(as_bytes.decode("utf-8"))
+            stack.append(as_bytes.decode("utf-8"))
+        return pos
 
-    def load_py2string(self):
-        as_bytes = self._read_byte_string()
+    def load_py2string(self, data, pos, stack):
+        as_bytes, pos = self._read_byte_string(data, pos)
         if ISPY3 and self.py2str_as_py3str:
-            s = as_bytes.decode("latin-1")
+            stack.append(as_bytes.decode("latin-1"))
         else:
-            s = as_bytes
-        self.stack.append(s)
+            stack.append(as_bytes)
+        return pos
 
-    def load_bytes(self):
-        s = self._read_byte_string()
-        self.stack.append(s)
+    def load_bytes(self, data, pos, stack):
+        as_bytes, pos = self._read_byte_string(data, pos)
+        stack.append(as_bytes)
+        return pos
 
-    def load_unicode(self):
-        self.stack.append(self._read_byte_string().decode("utf-8"))
+    def load_unicode(self, data, pos, stack):
+        as_bytes, pos = self._read_byte_string(data, pos)
+        stack.append(as_bytes.decode("utf-8"))
+        return pos
 
-    def load_newlist(self):
-        length = self._read_int4()
-        self.stack.append([None] * length)
+    def load_newlist(self, data, pos, stack):
+        stack.append([None] * self._read_int4(data, pos))
+        return pos + 4
 
-    def load_setitem(self):
-        if len(self.stack) < 3:
+    def load_setitem(self, data, pos, stack):
+        if len(stack) < 3:
             raise LoadError("not enough items for setitem")
-        value = self.stack.pop()
-        key = self.stack.pop()
-        self.stack[-1][key] = value
-
-    def load_newdict(self):
-        self.stack.append({})
-
-    def _load_collection(self, type_):
-        length = self._read_int4()
+        value = stack.pop()
+        key = stack.pop()
+        stack[-1][key] = value
+        return pos
+
+    def load_newdict(self, data, pos, stack):
+        stack.append({})
+        return pos
+
+    def _load_collection(self, data, pos, stack, type_):
+        end = pos + 4
+        if end > len(data):
+            self._fill(data, end)
+        length = _int4_struct.unpack_from(data, pos)[0]
         if length:
-            res = type_(self.stack[-length:])
-            del self.stack[-length:]
-            self.stack.append(res)
+            res = type_(stack[-length:])
+            del stack[-length:]
+            stack.append(res)
         else:
-            self.stack.append(type_())
-
-    def load_buildtuple(self):
-        self._load_collection(tuple)
-
-    def load_set(self):
-        self._load_collection(set)
-
-    def load_frozenset(self):
-        self._load_collection(frozenset)
-
-    def load_stop(self):
+            stack.append(type_())
+        return end
+
+    def load_list(self, data, pos, stack):
+        return self._load_collection(data, pos, stack, list)
+
+    def load_dict(self, data, pos, stack):
+        end = pos + 4
+        if end > len(data):
+            self._fill(data, end)
+        length = 2 * _int4_struct.unpack_from(data, pos)[0]
+        if len(stack) < length:
+            raise LoadError("not enough items for dict")
+        if length:
+            items = iter(stack[-length:])
+            del stack[-length:]
+            stack.append(dict(zip(items, items)))
+        else:
+            stack.append({})
+        return end
+
+    def load_buildtuple(self, data, pos, stack):
+        return self._load_collection(data, pos, stack, tuple)
+
+    def load_set(self, data, pos, stack):
+        return self._load_collection(data, pos, stack, set)
+
+    def load_frozenset(self, data, pos, stack):
+        return self._load_collection(data, pos, stack, frozenset)
+
+    def _read_array(self, data, pos):
+        end = pos + 5
+        if end > len(data):
+            self._fill(data, end)
+        wirecode, count = _op_int4_struct.unpack_from(data, pos)
+        typecode, itemsize = _array_wire_type(wirecode)
+        pos = end
+        end += count * itemsize
+        if end > len(data):
+            self._fill(data, end)
+        return _array_from_bytes(typecode, data[pos:end]), end
+
+    def load_array(self, data, pos, stack):
+        arr, pos = self._read_array(data, pos)
+        stack.append(arr)
+        return pos
+
+    def load_packedlist(self, data, pos, stack):
+        arr, pos = self._read_array(data, pos)
+        stack.append(arr.tolist())
+        return pos
+
+    def _read_bytearray(self, data, pos):
+        end = pos + 4 + self._read_int4(data, pos)
+        if end > len(data):
+            self._fill(data, end)
+        if type(data) is bytearray:
+            return data[pos+4:end], end
+        if HAS_MEMORYVIEW:
+            return bytearray(memoryview(data)[pos+4:end]), end
+        return bytearray(data[pos+4:end]), end
+
+    def load_bytearray(self, data, pos, stack):
+        as_bytes, pos = self._read_bytearray(data, pos)
+        stack.append(as_bytes)
+        return pos
+
+    def _read_varint(self, data, pos):
+        # unrolled for the up to 2 bytes that the serializer writes
+        if pos >= len(data):
+            self._fill(data, pos + 1)
+        z = data[pos]
+        if not ISPY3 and not isinstance(z, int): # str on Python2
+            z = ord(z)
+        if z >= 0x80:
+            pos += 1
+            if pos >= len(data):
+                self._fill(data, pos + 1)
+            byte = data[pos]
+            if not ISPY3 and not isinstance(byte, int):
+                byte = ord(byte)
+            if byte >= 0x80:
+                raise LoadError("varint too long")
+            z = z & 0x7f | byte << 7
+        return (z >> 1) ^ -(z & 1), pos + 1
+
+    def load_varint(self, data, pos, stack):
+        i, pos = self._read_varint(data, pos)
+        stack.append(i)
+        return pos
+
+    def load_bigint(self, data, pos, stack):
+        as_bytes, pos = self._read_byte_string(data, pos)
+        stack.append(_int_from_bytes(as_bytes))
+        return pos
+
+    def load_memo(self, data, pos, stack):
+        self.memo.append(_memoized(stack))
+        return pos
+
+    def load_strref(self, data, pos, stack):
+        index, pos = self._read_varint(data, pos)
+        stack.append(_memo_lookup(self.memo, index))
+        return pos
+
+    def load_ndarray(self, data, pos, stack):
+        as_bytes, pos = self._read_bytearray(data, pos)
+        if len(stack) < 2:
+            raise LoadError("not enough items for ndarray")
+        shape = stack.pop()
+        dtype = stack.pop()
+        stack.append(_ndarray_from_bytes(dtype, shape, as_bytes))
+        return pos
+
+    def load_stop(self, data, pos, stack):
+        self.pos = pos
         raise _Stop
 
-    def load_channel(self):
-        id = self._read_int4()
-        newchannel = self.channelfactory.new(id)
-        self.stack.append(newchannel)
+    def load_channel(self, data, pos, stack):
+        id = self._read_int4(data, pos)
+        stack.append(self.channelfactory.new(id))
+        return pos + 4
 
-# automatically build opcodes and byte-encoding
+# opcodes and their byte-encoding
 
 class opcode:
     """ container for name -> num mappings. """
 
+# the opcode numbers are part of the wire format and must never change,
+# new opcodes get the next free number.  Numbers from OPCODE_MIN up to
+# EXTENDED_OPCODE_MIN are written as a single byte, the extension range
+# from 0xF000 on as two bytes whose first one is 0xF0-0xFF.
+OPCODE_MIN = 0x40
+EXTENDED_OPCODE_MIN = 0xF0
+OPCODES = [
+    # format version 1, numbered alphabetically
+    ("BUILDTUPLE", 0x40),
+    ("BYTES", 0x41),
+    ("CHANNEL", 0x42),
+    ("FALSE", 0x43),
+    ("FLOAT", 0x44),
+    ("FROZENSET", 0x45),
+    ("INT", 0x46),
+    ("LONG", 0x47),
+    ("LONGINT", 0x48),
+    ("LONGLONG", 0x49),
+    ("NEWDICT", 0x4a),
+    ("NEWLIST", 0x4b),
+    ("NONE", 0x4c),
+    ("PY2STRING", 0x4d),
+    ("PY3STRING", 0x4e),
+    ("SET", 0x4f),
+    ("SETITEM", 0x50),
+    ("STOP", 0x51),
+    ("TRUE", 0x52),
+    ("UNICODE", 0x53),
+    # format version 2
+    ("LIST", 0x54),
+    ("DICT", 0x55),
+    # format version 3
+    ("ARRAY", 0x56),
+    ("PACKEDLIST", 0x57),
+    # format version 4
+    ("BYTEARRAY", 0x58),
+    ("NDARRAY", 0x59),
+    # format version 5
+    ("VARINT", 0x5a),
+    ("BIGINT", 0x5b),
+    # format version 6
+    ("MEMO", 0x5c),
+    ("STRREF", 0x5d),
+]
+
 def _buildopcodes():
-    l = []
-    for name, func in Unserializer.__dict__.items():
-        if name.startswith("load_"):
-            opname = name[5:].upper()
-            l.append((opname, func))
-    l.sort()
-    for i,(opname, func) in enumerate(l):
-        assert i < 26, "xxx"
-        i = bchr(64+i)
-        Unserializer.num2func[i] = func
-        setattr(opcode, opname, i)
+    numbers = set()
+    for opname, number in OPCODES:
+        assert number not in numbers, "duplicate opcode %r" % (opname,)
+        numbers.add(number)
+        loadername = "load_" + opname.lower()
+        func = Unserializer.__dict__[loadername]
+        if number < EXTENDED_OPCODE_MIN:
+            assert OPCODE_MIN <= number, opname
+            code = bchr(number)
+            # indexing bytes gives a character on Python2, an int otherwise
+            Unserializer.num2func[number] = func
+        else:
+            prefix = number >> 8
+            assert EXTENDED_OPCODE_MIN <= prefix <= 0xFF, opname
+            code = bchr(prefix) + bchr(number & 0xFF)
+            extended = Unserializer._load_extended
+            Unserializer.num2func[prefix] = extended
+            Unserializer.num2func[bchr(prefix)] = extended
+        Unserializer.num2func[code] = func
+        setattr(opcode, opname, code)
+    loaders = set([name[5:].upper() for name in Unserializer.__dict__
+                   if name.startswith("load_")])
+    assert loaders == set([opname for opname, number in OPCODES]), \
+        "load_* methods and OPCODES differ"
 
 _buildopcodes()
 
+# the complete encodings of the ints which fit into one varint byte
+_small_varints = [_op_varint(opcode.VARINT, i) for i in range(-64, 64)]
+
 def dumps(obj):
     """ return a serialized bytestring of the given obj.
 
@@ -1248,11 +2639,13 @@ def dumps(obj):
     python type (so nested dicts, sets, etc. are all ok but
     not user-level instances).
     """
-    return _Serializer().save(obj, versioned=True)
+    return _Serializer(version=ord(DUMPFORMAT_VERSION)).save(obj,
+                                                           versioned=True)
 
 def dump(byteio, obj):
     """ write a serialized bytestring of the given obj to the given stream. """
-    _Serializer(write=byteio.write).save(obj, versioned=True)
+    _Serializer(write=byteio.write, version=ord(DUMPFORMAT_VERSION)).save(
+        obj, versioned=True)
 
 def loads(bytestring, py2str_as_py3str=False, py3str_as_py2str=False):
     """ return the object as deserialized from the given bytestring.
@@ -1268,9 +2661,9 @@ def loads(bytestring, py2str_as_py3str=False, py3str_as_py2str=False):
     version or if the bytestring is corrupted, the
     ``execnet.DataFormatError`` will be raised.
     """
-    io = BytesIO(bytestring)
-    return load(io, py2str_as_py3str=py2str_as_py3str,
-                    py3str_as_py2str=py3str_as_py2str)
+    strconfig=(py2str_as_py3str, py3str_as_py2str)
+    return Unserializer(bytestring, strconfig=strconfig).load(
+        versioned=True)
 
 def load(io, py2str_as_py3str=False, py3str_as_py2str=False):
     """ derserialize an object form the specified stream.
@@ -1281,21 +2674,76 @@ def load(io, py2str_as_py3str=False, py3str_as_py2str=False):
     return Unserializer(io, strconfig=strconfig).load(versioned=True)
 
 def loads_internal(bytestring, channelfactory=None, strconfig=None):
-    io = BytesIO(bytestring)
-    return Unserializer(io, channelfactory, strconfig).load()
+    return Unserializer(bytestring, channelfactory, strconfig).load()
+
+def loads_many_internal(bytestring, channelfactory=None, strconfig=None):
+    """ return the list of items serialized one after another. """
+    unserializer = Unserializer(bytestring, channelfactory, strconfig)
+    items = []
+    while unserializer.pos < len(bytestring):
+        items.append(unserializer.load())
+    return items
+
+def loads_large_internal(large, channel=None, strconfig=None):
+    """ return the item from the (kind, bytearray) of a chunked item. """
+    kind, buf = large
+    strconfig = getattr(channel, '_strconfig', strconfig)
+    if strconfig:
+        py2str_as_py3str, py3str_as_py2str = strconfig
+    else:
+        py2str_as_py3str = Unserializer.py2str_as_py3str
+        py3str_as_py2str = Unserializer.py3str_as_py2str
+    if kind == "py3string" and not ISPY3 and py3str_as_py2str:
+        return bytes(buf)
+    if kind in ("py3string", "unicode"):
+        return buf.decode("utf-8")
+    if kind == "py2string" and ISPY3 and py2str_as_py3str:
+        return buf.decode("latin-1")
+    if kind == "data":
+        return loads_internal(buf, channel, strconfig)
+    if kind == "bytearray":
+        return buf
+    if kind[0] == "array":
+        return _array_from_bytes(_array_wire_type(kind[1])[0], buf)
+    if kind[0] == "ndarray":
+        return _ndarray_from_bytes(kind[1], kind[2], buf)
+    if kind[0] == "pickle5":
+        view = memoryview(buf)
+        parts = []
+        pos = 0
+        for size in kind[1]:
+            parts.append(view[pos:pos+size])
+            pos += size
+        return loads_pickled(parts[0], channel, buffers=parts[1:])
+    return bytes(buf)
+
+def loads_pickled(data, channel=None, strconfig=None, buffers=()):
+    """ return the item from pickle data sent with the pickle5 codec,
+    the out-of-band buffers are used without copying.  Receivers
+    must check that the channel chose the codec before. """
+    import pickle
+    return pickle.loads(data, buffers=buffers)
 
 def dumps_internal(obj):
     return _Serializer().save(obj)
 
 
 class _Serializer(object):
-    _dispatch = {}
+    _dispatch = {} # are filled by _builddispatch()
+    _containers = {}
 
-    def __init__(self, write=None):
+    def __init__(self, write=None, version=None, features=None):
         if write is None:
-            self._streamlist = []
-            write = self._streamlist.append
+            self._buffer = bytearray()
+            write = self._buffer.extend
         self._write = write
+        if version is None:
+            version = INTERNAL_FORMAT_VERSION
+        self.version = version
+        # the features of the other side, None if they are not known
+        self.features = features
+        self.channelids = []
+        self._memo = {}
 
     def save(self, obj, versioned=False):
         # calling here is not re-entrant but multiple instances
@@ -1306,16 +2754,34 @@ class _Serializer(object):
         self._save(obj)
         self._write(opcode.STOP)
         try:
-            streamlist = self._streamlist
+            buffer = self._buffer
         except AttributeError:
             return None
-        return type(streamlist[0])().join(streamlist)
+        return bytes(buffer)
 
     def _save(self, obj):
-        tp = type(obj)
+        # containers push their items and the bytes to write after them
+        # onto the todo stack instead of recursing, so that nesting depth
+        # is not limited by the Python stack
+        todo = [obj]
+        pop = todo.pop
+        containers = self._containers
+        while todo:
+            obj = pop()
+            if obj is _WRITE:
+                self._write(pop())
+                continue
+            push = containers.get(type(obj))
+            if push is not None:
+                push(self, obj, todo)
+            else:
+                self._save_leaf(obj)
+
+    def _save_leaf(self, obj):
         try:
-            dispatch = self._dispatch[tp]
+            dispatch = self._dispatch[type(obj)]
         except KeyError:
+            tp = type(obj)
             methodname = 'save_' + tp.__name__
             meth = getattr(self.__class__, methodname, None)
             if meth is None:
@@ -1323,6 +2789,21 @@ class _Serializer(object):
             dispatch = self._dispatch[tp] = meth
         dispatch(self, obj)
 
+    def _save_flat(self, items):
+        """ save the items if none of them is a container and return
+        True, return False otherwise. """
+        if _CONTAINER_TYPES.intersection(map(type, items)):
+            return False
+        dispatch = self._dispatch
+        for item in items:
+            try:
+                meth = dispatch[type(item)]
+            except KeyError:
+                self._save_leaf(item)
+            else:
+                meth(self, item)
+        return True
+
     def save_NoneType(self, non):
         self._write(opcode.NONE)
 
@@ -1333,94 +2814,193 @@ class _Serializer(object):
             self._write(opcode.FALSE)
 
     def save_bytes(self, bytes_):
-        self._write(opcode.BYTES)
-        self._write_byte_sequence(bytes_)
+        self._write_byte_sequence(opcode.BYTES, bytes_)
+
+    def save_str(self, s):
+        if self.version < 6 or len(s) > MEMO_MAX_LENGTH:
+            self._write_str(s)
+            return
+        memo = self._memo
+        index = memo.get(s)
+        if index is not None:
+            self._write(_op_varint(opcode.STRREF, index))
+            return
+        self._write_str(s)
+        if len(memo) < VARINT_LIMIT:
+            memo[s] = len(memo)
+            self._write(opcode.MEMO)
 
     if ISPY3:
-        def save_str(self, s):
-            self._write(opcode.PY3STRING)
-            self._write_unicode_string(s)
+        def _write_str(self, s):
+            self._write_unicode_string(opcode.PY3STRING, s)
     else:
-        def save_str(self, s):
-            self._write(opcode.PY2STRING)
-            self._write_byte_sequence(s)
+        def _write_str(self, s):
+            self._write_byte_sequence(opcode.PY2STRING, s)
 
         def save_unicode(self, s):
-            self._write(opcode.UNICODE)
-            self._write_unicode_string(s)
+            self._write_unicode_string(opcode.UNICODE, s)
 
-    def _write_unicode_string(self, s):
+    def _write_unicode_string(self, op, s):
         try:
             as_bytes = s.encode("utf-8")
         except UnicodeEncodeError:
             raise DumpError("strings must be utf-8 encodable")
-        self._write_byte_sequence(as_bytes)
+        self._write_byte_sequence(op, as_bytes)
 
-    def _write_byte_sequence(self, bytes_):
-        self._write_int4(len(bytes_), "string is too long")
+    def _write_byte_sequence(self, op, bytes_):
+        if len(bytes_) > FOUR_BYTE_INT_MAX:
+            raise DumpError("string is too long")
+        self._write(_op_int4_struct.pack(op, len(bytes_)))
         self._write(bytes_)
 
     def _save_integral(self, i, short_op, long_op):
         if i <= FOUR_BYTE_INT_MAX:
-            self._write(short_op)
-            self._write_int4(i)
+            self._write(_op_int4_struct.pack(short_op, i))
         else:
-            self._write(long_op)
-            self._write_byte_sequence(str(i).rstrip("L").encode("ascii"))
+            self._write_byte_sequence(long_op,
+                                      str(i).rstrip("L").encode("ascii"))
 
     def save_int(self, i):
-        self._save_integral(i, opcode.INT, opcode.LONGINT)
+        if self.version < 5:
+            self._save_integral(i, opcode.INT, opcode.LONGINT)
+        elif -64 <= i < 64:
+            self._write(_small_varints[i + 64])
+        elif -VARINT_LIMIT < i < VARINT_LIMIT:
+            self._write(_op_varint(opcode.VARINT, i))
+        elif -FOUR_BYTE_INT_MAX - 1 <= i <= FOUR_BYTE_INT_MAX:
+            self._write(_op_int4_struct.pack(opcode.INT, i))
+        else:
+            self._write_byte_sequence(opcode.BIGINT, _int_to_bytes(i))
 
     def save_long(self, l):
         self._save_integral(l, opcode.LONG, opcode.LONGLONG)
 
     def save_float(self, flt):
-        self._write(opcode.FLOAT)
-        self._write(struct.pack(FLOAT_FORMAT, flt))
+        self._write(_op_float_struct.pack(opcode.FLOAT, flt))
 
-    def _write_int4(self, i, error="int must be less than %i" %
-                    (FOUR_BYTE_INT_MAX,)):
+    def _op_int4(self, op, i, error="int must be less than %i" %
+                 (FOUR_BYTE_INT_MAX,)):
         if i > FOUR_BYTE_INT_MAX:
             raise DumpError(error)
-        self._write(struct.pack("!i", i))
-
-    def save_list(self, L):
-        self._write(opcode.NEWLIST)
-        self._write_int4(len(L), "list is too long")
-        for i, item in enumerate(L):
-            self._write_setitem(i, item)
-
-    def _write_setitem(self, key, value):
-        self._save(key)
-        self._save(value)
-        self._write(opcode.SETITEM)
-
-    def save_dict(self, d):
-        self._write(opcode.NEWDICT)
-        for key, value in d.items():
-            self._write_setitem(key, value)
-
-    def save_tuple(self, tup):
-        for item in tup:
-            self._save(item)
-        self._write(opcode.BUILDTUPLE)
-        self._write_int4(len(tup), "tuple is too long")
-
-    def _write_set(self, s, op):
-        for item in s:
-            self._save(item)
-        self._write(op)
-        self._write_int4(len(s), "set is too long")
-
-    def save_set(self, s):
-        self._write_set(s, opcode.SET)
-
-    def save_frozenset(self, s):
-        self._write_set(s, opcode.FROZENSET)
+        return _op_int4_struct.pack(op, i)
+
+    def _write_op_int4(self, op, i, error="int must be less than %i" %
+                       (FOUR_BYTE_INT_MAX,)):
+        self._write(self._op_int4(op, i, error))
+
+    def _push_list(self, L, todo):
+        if self.version < 2:
+            self._write_op_int4(opcode.NEWLIST, len(L), "list is too long")
+            for i in range(len(L) - 1, -1, -1):
+                todo.extend((opcode.SETITEM, _WRITE, L[i], i))
+            return
+        if self.version >= 3 and len(L) >= PACKED_LIST_MIN:
+            packed = _packed_list(L)
+            if packed is not None:
+                self._write_array(opcode.PACKEDLIST, packed)
+                return
+        self._push_items(L, self._op_int4(opcode.LIST, len(L),
+                                          "list is too long"), todo)
+
+    def _push_items(self, items, end, todo):
+        """ save the items followed by the end bytes. """
+        if self._save_flat(items):
+            self._write(end)
+        else:
+            todo.append(end)
+            todo.append(_WRITE)
+            todo.extend(reversed(items))
+
+    def _push_dict(self, d, todo):
+        if self.version < 2:
+            self._write(opcode.NEWDICT)
+            for key, value in reversed(list(d.items())):
+                todo.extend((opcode.SETITEM, _WRITE, value, key))
+            return
+        items = []
+        for item in d.items():
+            items.extend(item)
+        self._push_items(items, self._op_int4(opcode.DICT, len(d),
+                                              "dict is too long"), todo)
+
+    def _push_tuple(self, tup, todo):
+        self._push_items(tup, self._op_int4(opcode.BUILDTUPLE, len(tup),
+                                            "tuple is too long"), todo)
+
+    def _push_set(self, s, todo):
+        self._push_items(list(s), self._op_int4(opcode.SET, len(s),
+                                                "set is too long"), todo)
+
+    def _push_frozenset(self, s, todo):
+        self._push_items(list(s), self._op_int4(opcode.FROZENSET, len(s),
+                                                "set is too long"), todo)
+
+    def save_array(self, arr):
+        if self.version < 3:
+            raise DumpError("can't serialize %s" % (type(arr),))
+        self._write_array(opcode.ARRAY, arr)
+
+    def _write_array(self, op, arr):
+        try:
+            wirecode = _array_to_wire[arr.typecode]
+        except KeyError:
+            raise DumpError("can't serialize array of typecode %r" %
+                            (arr.typecode,))
+        if len(arr) > FOUR_BYTE_INT_MAX:
+            raise DumpError("array is too long")
+        if sys.byteorder == "big":
+            arr = array.array(arr.typecode, arr)
+            arr.byteswap()
+        self._write(_op_array_struct.pack(op, wirecode, len(arr)))
+        if ISPY3:
+            self._write(arr)
+        else:
+            self._write(arr.tostring())
+
+    def save_bytearray(self, ba):
+        if self.version < 4:
+            raise DumpError("can't serialize %s" % (type(ba),))
+        self._write_byte_sequence(opcode.BYTEARRAY, ba)
+
+    def save_memoryview(self, view):
+        # a memoryview has no data of its own, it is loaded as bytes
+        self._write_byte_sequence(opcode.BYTES, _byte_view(view))
+
+    def save_ndarray(self, arr):
+        if self.version < 4 or not _is_ndarray(arr):
+            raise DumpError("can't serialize %s" % (type(arr),))
+        if self.features is not None and "numpy" not in self.features:
+            raise DumpError("can't serialize ndarray, the other side "
+                            "has no numpy")
+        dtype, shape, data = _ndarray_parts(arr)
+        self._save(dtype)
+        self._save(shape)
+        self._write_byte_sequence(opcode.NDARRAY, data)
 
     def save_Channel(self, channel):
-        self._write(opcode.CHANNEL)
-        self._write_int4(channel.id)
+        self._write_op_int4(opcode.CHANNEL, channel.id)
+        self.channelids.append(channel.id)
+
+# marks that the entry below it on the todo stack is to be written
+_WRITE = object()
+
+_CONTAINER_TYPES = frozenset([list, dict, tuple, set, frozenset])
+
+def _builddispatch():
+    types = [type(None), bool, bytes, str, int, float, array.array,
+             bytearray, Channel]
+    if HAS_MEMORYVIEW:
+        types.append(memoryview)
+    if not ISPY3:
+        types.extend([unicode, long])
+    for tp in types:
+        _Serializer._dispatch[tp] = getattr(_Serializer,
+                                            "save_" + tp.__name__)
+    for tp in _CONTAINER_TYPES:
+        _Serializer._containers[tp] = getattr(_Serializer,
+                                              "_push_" + tp.__name__)
+
+_builddispatch()
 
 def init_popen_io(execmodel):
     if not hasattr(os, 'dup'): # jython
@@ -1457,6 +3037,83 @@ def init_popen_io(execmodel):
         sys.stdout = execmodel.fdopen(1, 'w', 1)
     return io
 
-def serve(io, id):
+def _importable(modname):
+    """ return True if the module can be imported, without importing it. """
+    if modname in sys.modules:
+        return True
+    try:
+        from importlib.util import find_spec
+    except ImportError: # Python2 and Python3 before 3.4
+        import imp
+        try:
+            imp.find_module(modname)
+        except ImportError:
+            return False
+        return True
+    return find_spec(modname) is not None
+
+def _marshal_feature():
+    # marshalled code objects are only valid for the same bytecode version
+    try:
+        from importlib.util import MAGIC_NUMBER
+    except ImportError:
+        try:
+            import imp
+            MAGIC_NUMBER = imp.get_magic()
+        except (ImportError, AttributeError):
+            return None
+    return "marshal-" + binascii.hexlify(MAGIC_NUMBER).decode("ascii")
+
+MARSHAL_FEATURE = _marshal_feature()
+
+# pickled items can only be exchanged between the same Python versions
+if sys.version_info >= (3, 8):
+    PICKLE5_FEATURE = "pickle5-%d.%d" % sys.version_info[:2]
+else:
+    PICKLE5_FEATURE = None
+
+def local_features():
+    """ return the names of the optional protocol features which this
+    side supports: "large" and "multi" for the CHANNEL_LARGE_DATA and
+    CHANNEL_DATA_MULTI messages, "codecache" for caching remote_exec
+    code and MARSHAL_FEATURE for receiving it marshalled, "sessions"
+    for persistent remote_exec namespaces, "zlib" for compression,
+    "numpy" for loading ndarrays and PICKLE5_FEATURE for the pickle5
+    codec. """
+    features = ["large", "multi", "codecache", "sessions"]
+    if MARSHAL_FEATURE is not None:
+        features.append(MARSHAL_FEATURE)
+    if _importable("zlib"):
+        features.append("zlib")
+    if _importable("numpy"):
+        features.append("numpy")
+    if PICKLE5_FEATURE is not None:
+        features.append(PICKLE5_FEATURE)
+    return features
+
+def negotiate_format(version, features):
+    """ return the highest common format version and the common
+    features for the ones offered by the other side. """
+    common = set(features).intersection(local_features())
+    return min(version, INTERNAL_FORMAT_VERSION), sorted(common)
+
+def serve(io, id, coalesce=None, compress=None, handshake=None):
+    """ serve the slave side of a gateway.  handshake is the format
+    version and the features offered by the master, the agreed ones
+    are sent back in a GATEWAY_HELLO message as the first message.
+    Without a handshake only format version 1 is sent. """
     trace("creating slavegateway on %r" %(io,))
-    SlaveGateway(io=io, id=id, _startcount=2).serve()
+    gateway = SlaveGateway(io=io, id=id, _startcount=2)
+    if handshake:
+        version, features = negotiate_format(*handshake)
+        gateway._set_format(version, features)
+        gateway._send(Message.GATEWAY_HELLO, data=_Serializer(version=1).save(
+            (version, features)))
+    if coalesce:
+        gateway._start_writer(coalesce)
+    if compress:
+        if "zlib" in gateway._features:
+            gateway._start_compression(compress)
+        else:
+            trace("not compressing, the other side has no zlib")
+    gateway.serve()
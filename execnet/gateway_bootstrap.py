@@ -21,7 +21,7 @@ def bootstrap_popen(io, spec):
         "sys.stdout.write('1')",
         "sys.stdout.flush()",
         "execmodel = get_execmodel(%r)" % spec.execmodel,
-        "serve(init_popen_io(execmodel), id='%s-slave')" % spec.id,
+        serve_source("init_popen_io(execmodel)", spec),
     )
     s = io.read(1)
     assert s == "1".encode('ascii'), repr(s)
@@ -34,7 +34,7 @@ def bootstrap_ssh(io, spec):
             "execmodel = get_execmodel(%r)" % spec.execmodel,
             'io = init_popen_io(execmodel)',
             "io.write('1'.encode('ascii'))",
-            "serve(io, id='%s-slave')" % spec.id,
+            serve_source("io", spec),
         )
         s = io.read(1)
         assert s == "1".encode('ascii')
@@ -44,8 +44,7 @@ def bootstrap_ssh(io, spec):
             raise HostNotFound(io.remoteaddress)
 
 
-def bootstrap_socket(io, id):
-    #XXX: switch to spec
+def bootstrap_socket(io, spec):
     from execnet.gateway_socket import SocketIO
 
     sendexec(io,
@@ -57,12 +56,30 @@ def bootstrap_socket(io, id):
         "   execmodel = get_execmodel('thread')",
         "io = SocketIO(clientsock, execmodel)",
         "io.write('1'.encode('ascii'))",
-        "serve(io, id='%s-slave')" % id,
+        serve_source("io", spec),
     )
     s = io.read(1)
     assert s == "1".encode('ascii')
 
 
+def serve_source(io_source, spec):
+    """ return source for serving the slave side of the gateway. """
+    handshake = (gateway_base.INTERNAL_FORMAT_VERSION,
+                 gateway_base.local_features())
+    return ("serve(%s, id='%s-slave', coalesce=%r, compress=%r, "
+            "handshake=%r)" % (io_source, spec.id, spec.coalesce,
+                               spec.compress, handshake))
+
+
+def receive_hello(io):
+    """ return the format version and features agreed on by the slave,
+    its GATEWAY_HELLO is the first message after bootstrapping. """
+    message = gateway_base.Message.from_io(io)
+    if message.msgcode != gateway_base.Message.GATEWAY_HELLO:
+        raise EOFError("expected GATEWAY_HELLO, got %r" % (message,))
+    return gateway_base.loads_internal(message.data)
+
+
 def sendexec(io, *sources):
     source = "\n".join(sources)
     io.write((repr(source)+ "\n").encode('ascii'))
@@ -90,7 +107,7 @@ def bootstrap(io, spec):
         bootstrap_socket(io, spec)
     else:
         raise ValueError('unknown gateway type, cant bootstrap')
-    gw = Gateway(io, spec)
+    gw = Gateway(io, spec, format=receive_hello(io))
     fix_pid_for_jython_popen(gw)
     return gw
 
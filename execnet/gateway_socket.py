@@ -1,4 +1,6 @@
+from __future__ import with_statement
 from execnet.gateway_bootstrap import HostNotFound
+from execnet.gateway_base import ReadBuffer, write_buffers
 import sys
 
 try: bytes
@@ -8,12 +10,18 @@ class SocketIO:
     def __init__(self, sock, execmodel):
         self.sock = sock
         self.execmodel = execmodel
+        # writes may need several system calls for one message,
+        # messages sent from different threads must not interleave
+        self._writelock = execmodel.Lock()
         socket = execmodel.socket
         try:
             sock.setsockopt(socket.SOL_IP, socket.IP_TOS, 0x10)# IPTOS_LOWDELAY
             sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
         except (AttributeError, socket.error):
             sys.stderr.write("WARNING: cannot set socketoption")
+        # memoryview is needed for buffering, it is missing before 2.7
+        if hasattr(sock, 'recv_into') and sys.version_info >= (2, 7):
+            self.read = ReadBuffer(sock.recv_into).read
 
     def read(self, numbytes):
         "Read exactly 'bytes' bytes from the socket."
@@ -26,7 +34,16 @@ class SocketIO:
         return buf
 
     def write(self, data):
-        self.sock.sendall(data)
+        with self._writelock:
+            self.sock.sendall(data)
+
+    def writev(self, buffers):
+        """write out all bytes of the given buffers without joining them. """
+        if hasattr(self.sock, 'sendmsg'):
+            with self._writelock:
+                write_buffers(self.sock.sendmsg, buffers)
+        else:
+            self.write(bytes().join(buffers))
 
     def close_read(self):
         try:
@@ -9,6 +9,7 @@ import sys, atexit
 from execnet import XSpec
 from execnet import gateway_io, gateway_bootstrap
 from execnet.gateway_base import reraise, trace, get_execmodel
+from execnet.gateway_base import parse_compress_spec
 from threading import Lock
 
 NO_ENDMARKER_WANTED = object()
@@ -103,6 +104,14 @@ class Group(object):
             chdir=<path>    specifies to which directory to change
             nice=<path>     specifies process priority of new process
             env:NAME=value  specifies a remote environment variable setting.
+            coalesce=DELAY[:MAXBYTES] send through writer threads which
+                            coalesce queued messages into single writes,
+                            waiting up to DELAY seconds (default 0) for
+                            more messages until MAXBYTES (default 65536)
+                            are pending.
+            compress=zlib[:LEVEL] zlib-compress larger message payloads
+                            in both directions (default level 1),
+                            skipping data which does not compress well.
 
         If no spec is given, self.defaultspec is used.
         """
@@ -111,6 +120,8 @@ class Group(object):
         if not isinstance(spec, XSpec):
             spec = XSpec(spec)
         self.allocate_id(spec)
+        if spec.compress:
+            parse_compress_spec(spec.compress) # fail before starting a process
         if spec.execmodel is None:
             spec.execmodel = self.remote_execmodel.backend
         if spec.via:
@@ -11,7 +11,7 @@ class XSpec:
     """
     # XXX allow customization, for only allow specific key names
     popen = ssh = socket = python = chdir = nice = \
-            dont_write_bytecode = execmodel = None
+            dont_write_bytecode = execmodel = coalesce = compress = None
 
     def __init__(self, string):
         self._spec = string
@@ -44,6 +44,199 @@ def test_serializer_api_version_error(monkeypatch):
     monkeypatch.setattr(gateway_base, 'DUMPFORMAT_VERSION', bchr(2))
     pytest.raises(execnet.DataFormatError, lambda: execnet.loads(dumped))
 
+def test_serializer_list_opcode():
+    opcode = gateway_base.opcode
+    data = ["23", 25, [], [None, 1.5]]
+    internal = gateway_base.dumps_internal(data)
+    assert opcode.LIST in internal and opcode.NEWLIST not in internal
+    assert gateway_base.loads_internal(internal) == data
+    # the public format stays at version 1
+    dumped = execnet.dumps(data)
+    assert opcode.NEWLIST in dumped and opcode.LIST not in dumped
+    assert execnet.loads(dumped) == data
+    assert len(internal) < len(dumped)
+
+def test_serializer_dict_opcode():
+    opcode = gateway_base.opcode
+    data = {"a": 1, 2: [{}, {(1, 2): None}], None: {"x": "y"}}
+    internal = gateway_base.dumps_internal(data)
+    assert opcode.DICT in internal and opcode.NEWDICT not in internal
+    assert gateway_base.loads_internal(internal) == data
+    dumped = execnet.dumps(data)
+    assert opcode.NEWDICT in dumped
+    assert execnet.loads(dumped) == data
+
+def test_serializer_loads_from_buffers():
+    data = {"a": [1, 2.5, "x", b"y"], 2: (None, True, set([3]), 2**40)}
+    internal = gateway_base.dumps_internal(data)
+    for buf in (internal, bytearray(internal), memoryview(internal)):
+        assert gateway_base.loads_internal(buf) == data
+    many = gateway_base.loads_many_internal(internal + internal)
+    assert many == [data, data]
+    pytest.raises(EOFError, lambda: gateway_base.loads_internal(internal[:-1]))
+
+def test_serializer_loads_from_stream():
+    data = [{"kind": "file", "size": 2**40}, bytearray(b"x"), -3, "kind"]
+    internal = gateway_base.dumps_internal(data)
+    class Pipe(object):
+        # not seekable and reading at most 3 bytes at once
+        def __init__(self, data):
+            self._f = BytesIO(data)
+        def read(self, size):
+            return self._f.read(min(size, 3))
+        def tell(self):
+            return self._f.tell()
+    for f in (BytesIO(internal + internal[:-1]),
+              Pipe(internal + internal[:-1])):
+        unserializer = gateway_base.Unserializer(f)
+        assert unserializer.load() == data
+        assert f.tell() == len(internal)  # the next item is not read
+        pytest.raises(EOFError, unserializer.load)
+
+def test_serializer_stream_and_buffer_agree():
+    data = [None, True, False, -3, 2**40, 1.5, "x", b"y", (1,), {1: {}}]
+    f = BytesIO()
+    execnet.dump(f, data)
+    assert f.getvalue() == execnet.dumps(data)
+    assert type(gateway_base.dumps_internal(data)) is bytes
+    class Unknown(object):
+        pass
+    pytest.raises(gateway_base.DumpError,
+                  lambda: gateway_base.dumps_internal([Unknown()]))
+
+def test_serializer_packed_arrays():
+    import array
+    opcode = gateway_base.opcode
+    data = [list(range(-10, 10)), [2**40] * 10, [0.5] * 10, [2**70] * 10,
+            [1, 2.0] * 5, [True] * 10, array.array("d", [1.5, 2.5]),
+            array.array("H", [0, 65535]), array.array("b")]
+    internal = gateway_base.dumps_internal(data)
+    assert opcode.PACKEDLIST in internal and opcode.ARRAY in internal
+    loaded = gateway_base.loads_internal(internal)
+    assert loaded == data
+    assert type(loaded[5][0]) is bool and type(loaded[4][1]) is float
+    assert loaded[7].typecode == "H"
+    assert gateway_base.Unserializer(BytesIO(internal)).load() == data
+    pytest.raises(gateway_base.DumpError,
+                  lambda: execnet.dumps(array.array("d")))
+
+def test_serializer_buffer_objects():
+    import array
+    data = [bytearray(b"abc"), memoryview(b"xyz"), bytearray(),
+            memoryview(array.array("b", [1, 2]))]
+    internal = gateway_base.dumps_internal(data)
+    assert gateway_base.loads_internal(internal) == [
+        bytearray(b"abc"), b"xyz", bytearray(), b"\x01\x02"]
+    assert execnet.loads(execnet.dumps(memoryview(b"xyz"))) == b"xyz"
+    pytest.raises(gateway_base.DumpError,
+                  lambda: execnet.dumps(bytearray(b"abc")))
+
+def test_serializer_ndarray():
+    numpy = pytest.importorskip("numpy")
+    data = [numpy.arange(12, dtype=">i4").reshape(3, 4),
+            numpy.arange(12.0).reshape(3, 4).T, numpy.array(2.5)]
+    loaded = gateway_base.loads_internal(gateway_base.dumps_internal(data))
+    for arr, loadedarr in zip(data, loaded):
+        assert arr.dtype == loadedarr.dtype
+        assert (arr == loadedarr).all()
+    loaded[0][0, 0] = 42  # loaded arrays are writable
+    pytest.raises(gateway_base.DumpError, lambda:
+                  gateway_base.dumps_internal(numpy.array([None])))
+    kind, data = gateway_base._buffer_parts(data[1])
+    assert kind == ("ndarray", "<f8", (4, 3))
+    assert gateway_base.loads_large_internal((kind, bytearray(data)))[1, 2] == 9
+
+def test_serializer_varint_and_bigint():
+    opcode = gateway_base.opcode
+    data = [0, -1, 63, -64, 64, 8191, -8192, 8192, 2**31 - 1, -2**31,
+            2**31, -2**31 - 1, 2**200, -2**200]
+    internal = gateway_base.dumps_internal(tuple(data))
+    assert opcode.VARINT in internal and opcode.BIGINT in internal
+    assert opcode.LONGINT not in internal
+    assert gateway_base.loads_internal(internal) == tuple(data)
+    assert gateway_base.Unserializer(BytesIO(internal)).load() == tuple(data)
+    assert len(gateway_base.dumps_internal(5)) == 3
+    assert opcode.LONGINT in execnet.dumps(2**40)
+
+def test_serializer_string_memo():
+    opcode = gateway_base.opcode
+    records = [{"name": "n%d" % i, "kind": "file"} for i in range(100)]
+    internal = gateway_base.dumps_internal(records)
+    assert internal.count("kind".encode("ascii")) == 1
+    assert opcode.STRREF in internal
+    loaded = gateway_base.loads_internal(internal)
+    assert loaded == records
+    assert gateway_base.Unserializer(BytesIO(internal)).load() == records
+    # each message has its own memo
+    items = gateway_base.loads_many_internal(internal + internal)
+    assert items == [records, records]
+    assert opcode.STRREF not in execnet.dumps(["kind", "kind"])
+
+def test_serializer_deep_nesting():
+    obj = []
+    for i in range(sys.getrecursionlimit() * 2):
+        obj = [obj, (i,)]
+    for version in range(1, gateway_base.INTERNAL_FORMAT_VERSION + 1):
+        serializer = gateway_base._Serializer(version=version)
+        loaded = gateway_base.loads_internal(serializer.save(obj))
+        for i in reversed(range(sys.getrecursionlimit() * 2)):
+            assert loaded[1] == (i,)
+            loaded = loaded[0]
+        assert loaded == []
+
+def test_negotiate_format(monkeypatch):
+    monkeypatch.setattr(gateway_base, "local_features",
+                        lambda: ["large", "multi"])
+    version = gateway_base.INTERNAL_FORMAT_VERSION
+    assert gateway_base.negotiate_format(version + 1, ["multi", "new"]) == (
+        version, ["multi"])
+    assert gateway_base.negotiate_format(1, []) == (1, [])
+
+def test_serializer_refuses_ndarray_without_peer_numpy():
+    numpy = pytest.importorskip("numpy")
+    serializer = gateway_base._Serializer(features=frozenset(["multi"]))
+    pytest.raises(gateway_base.DumpError,
+                  lambda: serializer.save(numpy.arange(3)))
+
+def test_code_cache():
+    cache = gateway_base.CodeCache(size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+def test_opcode_numbers_are_stable():
+    opcode = gateway_base.opcode
+    assert opcode.BUILDTUPLE == gateway_base.bchr(0x40)
+    assert opcode.UNICODE == gateway_base.bchr(0x53)
+    assert opcode.STRREF == gateway_base.bchr(0x5d)
+    single = gateway_base.EXTENDED_OPCODE_MIN - gateway_base.OPCODE_MIN
+    assert single >= 128
+
+def test_extended_opcode(monkeypatch):
+    Unserializer = gateway_base.Unserializer
+    def load_answer(self, data, pos, stack):
+        stack.append(42)
+        return pos
+    monkeypatch.setattr(Unserializer, "load_answer", load_answer,
+                        raising=False)
+    monkeypatch.setattr(Unserializer, "num2func", {})
+    monkeypatch.setattr(gateway_base.opcode, "ANSWER", None, raising=False)
+    monkeypatch.setattr(gateway_base, "OPCODES",
+                        gateway_base.OPCODES + [("ANSWER", 0xF001)])
+    gateway_base._buildopcodes()
+    opcode = gateway_base.opcode
+    assert len(opcode.ANSWER) == 2
+    data = opcode.ANSWER + opcode.STOP
+    assert gateway_base.loads_internal(data) == 42
+    assert Unserializer(BytesIO(data)).load() == 42
+    unknown = opcode.ANSWER[:1] + gateway_base.bchr(2) + opcode.STOP
+    pytest.raises(gateway_base.LoadError,
+                  lambda: gateway_base.loads_internal(unknown))
+
 def test_errors_on_execnet():
     assert hasattr(execnet, 'RemoteError')
     assert hasattr(execnet, 'TimeoutError')
@@ -156,6 +349,152 @@ def test_popen_io_readloop(monkeypatch, execmodel):
     result = io.read(3)
     assert result == 'tes'.encode('ascii')
 
+def test_write_buffers_partial():
+    written = []
+    def writev(buffers):
+        assert len(buffers) <= gateway_base.IOV_MAX
+        data = bytes().join([bytes(buf) for buf in buffers])[:3]
+        written.append(data)
+        return len(data)
+    buffers = ['abcde'.encode('ascii'), bytes(), 'f'.encode('ascii')] * 1000
+    gateway_base.write_buffers(writev, buffers)
+    assert bytes().join(written) == bytes().join(buffers)
+
+@pytest.mark.skipif("not hasattr(os, 'writev')")
+def test_popen_io_writev(execmodel):
+    r, w = os.pipe()
+    io = Popen2IO(os.fdopen(w, 'wb'), os.fdopen(r, 'rb'), execmodel)
+    message = Message(Message.CHANNEL_DATA, 5, 'hello'.encode('ascii'))
+    message.to_io(io)
+    assert Message.from_io(io).data == message.data
+    io.close_write()
+    io.close_read()
+
+def test_readbuffer():
+    data = bytes().join([Message(Message.CHANNEL_DATA, i,
+                                 'x'.encode('ascii') * i * 1000).pack()
+                         for i in range(100)])
+    sio = BytesIO(data)
+    calls = []
+    def readinto(buf):
+        calls.append(len(buf))
+        chunk = sio.read(min(len(buf), 70000))
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+    io = gateway_base.ReadBuffer(readinto)
+    for i in range(100):
+        msg = Message.from_io(io)
+        assert msg.channelid == i
+        assert msg.data == 'x'.encode('ascii') * i * 1000
+    assert len(calls) < 100
+    py.test.raises(EOFError, lambda: io.read(1))
+
+def test_coalescing_writer(execmodel):
+    class FakeIO:
+        def __init__(self):
+            self.writes = []
+        def write(self, data):
+            self.writes.append(data)
+    io = FakeIO()
+    writer = gateway_base.CoalescingWriter(io, execmodel, delay=0.5,
+                                           maxbytes=1000)
+    messages = [Message(Message.CHANNEL_DATA, 3, 'x'.encode('ascii') * i)
+                for i in range(10)]
+    for message in messages:
+        writer.put(message)
+    assert writer.close(timeout=5.0)
+    data = bytes().join([message.pack() for message in messages])
+    assert bytes().join(io.writes) == data
+    assert len(io.writes) < len(messages)
+    py.test.raises(IOError, lambda: writer.put(messages[0]))
+
+def test_coalescing_writer_priority(execmodel):
+    class BlockingIO:
+        def __init__(self):
+            self.writes = []
+            self.go = execmodel.Event()
+        def write(self, data):
+            self.go.wait()
+            self.writes.append(data)
+    io = BlockingIO()
+    writer = gateway_base.CoalescingWriter(io, execmodel, maxbytes=1)
+    def put(msgcode, channelid, refs=()):
+        message = Message(msgcode, channelid, 'x'.encode('ascii') * len(order))
+        order.append(message.pack())
+        writer.put(message, refs)
+    order = []
+    put(Message.CHANNEL_DATA, 3)
+    put(Message.CHANNEL_DATA, 3)
+    put(Message.CHANNEL_DATA, 7, refs=(9,))
+    put(Message.STATUS, 5)
+    put(Message.CHANNEL_CLOSE, 3)
+    put(Message.CHANNEL_CLOSE, 9)
+    put(Message.CHANNEL_CLOSE, 11)
+    put(Message.GATEWAY_TERMINATE, 0)
+    io.go.set()
+    assert writer.close(timeout=5.0)
+    assert sorted(io.writes) == sorted(order)
+    pos = [io.writes.index(data) for data in order]
+    # status and the close of an idle channel jump ahead
+    assert pos[3] < pos[1] and pos[6] < pos[1]
+    # but not ahead of data for or referencing their channel
+    assert pos[4] > pos[1] and pos[5] > pos[2]
+    assert pos[7] == len(order) - 1
+
+def test_coalescing_writer_error(execmodel):
+    class FailingIO:
+        def __init__(self):
+            self.go = execmodel.Event()
+        def write(self, data):
+            self.go.wait()
+            raise IOError("broken pipe")
+    failed = []
+    io = FailingIO()
+    writer = gateway_base.CoalescingWriter(
+        io, execmodel, maxbytes=1,
+        onerror=lambda ids, error: failed.append((ids, str(error))))
+    data = 'x'.encode('ascii')
+    writer.put(Message(Message.CHANNEL_DATA, 3, data))
+    writer.put(Message(Message.CHANNEL_DATA, 5, data), refs=(7,))
+    writer.put(Message(Message.CHANNEL_CLOSE, 9, bytes()))
+    writer.put(Message(Message.GATEWAY_TERMINATE, 0, bytes()))
+    io.go.set()
+    assert writer.close(timeout=5.0)
+    assert failed == [([3, 5, 7, 9], "broken pipe")]
+    excinfo = py.test.raises(IOError, lambda: writer.put(
+        Message(Message.CHANNEL_DATA, 3, data)))
+    assert "broken pipe" in str(excinfo.value)
+
+def test_compressor_skips_incompressible():
+    compressor = gateway_base.Compressor(level=1)
+    assert compressor.compress('x'.encode('ascii') * 100) is None
+    data = 'x'.encode('ascii') * 10000
+    compressed = compressor.compress(data)
+    assert len(compressed) < len(data)
+    noise = os.urandom(10000)
+    assert compressor.compress(noise) is None
+    # the next payload is skipped even if it would compress well
+    assert compressor.compress(data) is None
+    assert compressor.compress(data) == compressed
+    for i in range(200):
+        compressor.compress(noise)
+    assert compressor._backoff == compressor.maxskip
+
+def test_parse_compress_spec():
+    parse = gateway_base.parse_compress_spec
+    assert parse(True) == 1
+    assert parse("zlib") == 1
+    assert parse("zlib:9") == 9
+    py.test.raises(ValueError, lambda: parse("lzma"))
+    py.test.raises(ValueError, lambda: parse("zlib:10"))
+
+def test_parse_coalesce_spec():
+    parse = gateway_base.parse_coalesce_spec
+    assert parse(True) == (0.0, 65536)
+    assert parse("0.01") == (0.01, 65536)
+    assert parse("0.01:1024") == (0.01, 1024)
+    assert parse(":1024") == (0.0, 1024)
+
 def test_rinfo_source(anypython, tmpdir):
     check = tmpdir.join("check.py")
     check.write(py.code.Source("""
@@ -302,6 +641,19 @@ class TestSourceOfFunction(object):
         expected = 'def working(channel):\n    pass\n'
         assert send_source == expected
 
+    def test_source_is_cached_until_file_changes(self, tmpdir):
+        path = tmpdir.join("remotefunc.py")
+        path.write("def f(channel):\n    pass\n")
+        mod = path.pyimport()
+        source = gateway._source_of_function(mod.f)
+        assert source == "def f(channel):\n    pass\n"
+        assert gateway._source_of_function(mod.f) is source
+        assert gateway._source_of_module(mod) == source
+        path.write("def f(channel):\n    channel.send(1)\n")
+        path.setmtime(path.mtime() + 10)
+        assert "send" in gateway._source_of_function(mod.f)
+        assert "send" in gateway._source_of_module(mod)
+
 
 class TestGlobalFinder(object):
     pytestmark = pytest.mark.skipif('sys.version_info < (2, 6)')
@@ -55,6 +55,191 @@ class TestChannelBasicBehaviour:
         assert x == 42
         pytest.raises(channel.RemoteError, channel.receive)
 
+    def test_channel_large_items(self, gw):
+        from execnet.gateway_base import LARGE_ITEM_SIZE
+        channel = gw.remote_exec("""
+            for item in channel:
+                channel.send(item)
+        """)
+        data = "abc".encode("ascii") * (LARGE_ITEM_SIZE // 2)
+        channel.send(data)
+        assert channel.receive(TESTTIMEOUT) == data
+        text = py.builtin._totext("\xe4", "latin-1") * (LARGE_ITEM_SIZE + 1)
+        channel.send(text)
+        assert channel.receive(TESTTIMEOUT) == text
+        channel.send(42)
+        assert channel.receive(TESTTIMEOUT) == 42
+        channel.close()
+        channel.waitclose(TESTTIMEOUT)
+
+    def test_channel_buffer_items(self, gw):
+        import array
+        from execnet.gateway_base import LARGE_BUFFER_SIZE
+        channel = gw.remote_exec("""
+            for item in channel:
+                channel.send(item)
+        """)
+        for size in (10, LARGE_BUFFER_SIZE + 1):
+            data = bytearray(b"x") * size
+            channel.send(data)
+            assert channel.receive(TESTTIMEOUT) == data
+            floats = array.array("d", [0.5]) * size
+            channel.send(floats)
+            assert channel.receive(TESTTIMEOUT) == floats
+            channel.send(memoryview(data))
+            assert channel.receive(TESTTIMEOUT) == bytes(data)
+        channel.close()
+        channel.waitclose(TESTTIMEOUT)
+
+    def test_channel_pickle5_codec(self, gw):
+        from execnet.gateway_base import PICKLE5_FEATURE, LARGE_BUFFER_SIZE
+        if PICKLE5_FEATURE not in gw._features:
+            pytest.skip("no pickle5 codec with %r" % (gw,))
+        channel = gw.remote_exec("""
+            for item in channel:
+                channel.send(item)
+        """)
+        channel.reconfigure(codec="pickle5")
+        import datetime
+        for item in (datetime.date(2013, 1, 2),
+                     bytearray(b"x") * (LARGE_BUFFER_SIZE + 1)):
+            channel.send(item)
+            assert channel.receive(TESTTIMEOUT) == item
+        pytest.raises(ValueError, lambda: channel.reconfigure(codec="xml"))
+        channel.close()
+        channel.waitclose(TESTTIMEOUT)
+
+    def test_channel_pickle5_codec_callback(self, gw):
+        from execnet.gateway_base import PICKLE5_FEATURE, LARGE_BUFFER_SIZE
+        if PICKLE5_FEATURE not in gw._features:
+            pytest.skip("no pickle5 codec with %r" % (gw,))
+        channel = gw.remote_exec("""
+            import datetime
+            channel.receive()
+            channel.send(datetime.date(2013, 1, 2))
+            channel.send(bytearray(b"x") * %d)
+        """ % (LARGE_BUFFER_SIZE + 1))
+        channel.reconfigure(codec="pickle5")
+        items = queue.Queue()
+        channel.setcallback(items.put)
+        channel.send(None)
+        del channel  # the callback keeps receiving with the codec
+        import datetime
+        assert items.get(timeout=TESTTIMEOUT) == datetime.date(2013, 1, 2)
+        assert items.get(timeout=TESTTIMEOUT) == \
+            bytearray(b"x") * (LARGE_BUFFER_SIZE + 1)
+
+    def test_channel_window_blocks_sender(self, gw):
+        channel = gw.remote_exec("""
+            control = channel.gateway.newchannel()
+            channel.setwindow(4)
+            channel.send(control)
+            control.receive()
+            channel.send([channel.receive() for i in range(5)])
+        """)
+        control = channel.receive(TESTTIMEOUT)
+        for i in range(4):
+            channel.send(i, timeout=TESTTIMEOUT)
+        pytest.raises(channel.TimeoutError, channel.send, 4, timeout=0.2)
+        control.send("go")
+        channel.send(4, timeout=TESTTIMEOUT)
+        assert channel.receive(TESTTIMEOUT) == [0, 1, 2, 3, 4]
+        channel.waitclose(TESTTIMEOUT)
+
+    def test_channel_window_dumperror_keeps_credits(self, gw):
+        from execnet.gateway_base import DumpError
+        channel = gw.remote_exec("""
+            control = channel.gateway.newchannel()
+            channel.setwindow(5)
+            channel.send(control)
+            control.receive()
+            channel.send([channel.receive() for i in range(5)])
+        """)
+        control = channel.receive(TESTTIMEOUT)
+        pytest.raises(DumpError, channel.send, object())
+        pytest.raises(DumpError, channel.send_many, [0, 1, object(), 2])
+        channel.send_many([2, 3, 4], timeout=0.5)
+        control.send("go")
+        assert channel.receive(TESTTIMEOUT) == [0, 1, 2, 3, 4]
+        channel.waitclose(TESTTIMEOUT)
+
+    def test_channel_window_with_callback(self, gw):
+        channel = gw.remote_exec("""
+            items = []
+            def callback(item):
+                items.append(item)
+                if len(items) == 50:
+                    channel.send(items)
+            channel.setcallback(callback)
+            channel.setwindow(2)
+            channel.send("ready")
+            channel.waitclose()
+        """)
+        assert channel.receive(TESTTIMEOUT) == "ready"
+        for i in range(50):
+            channel.send(i, timeout=TESTTIMEOUT)
+        assert channel.receive(TESTTIMEOUT) == list(range(50))
+        channel.close()
+
+    def test_channel_send_many(self, gw):
+        channel = gw.remote_exec("""
+            items = [channel.receive() for i in range(3000)]
+            channel.send_many(iter(items))
+        """)
+        items = [(i, "x" * (i % 100)) for i in range(3000)]
+        channel.send_many(items)
+        for item in items:
+            assert channel.receive(TESTTIMEOUT) == item
+        channel.waitclose(TESTTIMEOUT)
+
+    def test_channel_send_many_callback_and_window(self, gw):
+        channel = gw.remote_exec("""
+            items = []
+            def callback(item):
+                items.append(item)
+                if len(items) == 1000:
+                    channel.send(items)
+            channel.setcallback(callback)
+            channel.setwindow(10)
+            channel.send("ready")
+            channel.waitclose()
+        """)
+        assert channel.receive(TESTTIMEOUT) == "ready"
+        channel.send_many(range(1000), timeout=TESTTIMEOUT)
+        assert channel.receive(TESTTIMEOUT) == list(range(1000))
+        channel.close()
+
+    def test_channel_window_callback_without_channel(self, gw):
+        channel = gw.remote_exec("""
+            channel.receive()
+            blocked = False
+            for i in range(100):
+                try:
+                    channel.send(i, timeout=0.1)
+                except channel.TimeoutError:
+                    blocked = True
+                    channel.send(i)
+            channel.send(blocked)
+        """)
+        items = queue.Queue()
+        def callback(item):
+            if item == 0:
+                time.sleep(0.5)  # the other side runs out of credits
+            items.put(item)
+        channel.setcallback(callback)
+        channel.setwindow(4)
+        channel.send(None)
+        del channel  # credits are given back without the channel object
+        assert [items.get(timeout=TESTTIMEOUT) for i in range(100)] == \
+            list(range(100))
+        assert items.get(timeout=TESTTIMEOUT) is True
+
+    def test_channel_window_invalid(self, gw):
+        channel = gw.newchannel()
+        pytest.raises(ValueError, channel.setwindow, 0)
+        channel.setwindow(1)
+        pytest.raises(ValueError, channel.setwindow, 1)
+
     def test_channel__local_close(self, gw):
         channel = gw._channelfactory.new()
         gw._channelfactory._local_close(channel.id)
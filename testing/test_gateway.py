@@ -167,6 +167,94 @@ class TestBasicGateway:
         res = channel.receive()
         assert res == 42
 
+    def test_format_negotiated(self, gw):
+        assert gw._format_version == gateway_base.INTERNAL_FORMAT_VERSION
+        assert "multi" in gw._features and "large" in gw._features
+        channel = gw.remote_exec("""
+            gw = channel.gateway
+            channel.send((gw._format_version, sorted(gw._features)))
+        """)
+        version, features = channel.receive(TESTTIMEOUT)
+        assert version == gw._format_version
+        assert set(features) == gw._features
+
+    def test_concurrent_large_sends(self, gw):
+        import threading
+        channel = gw.remote_exec("""
+            sizes = [len(channel.receive()) for i in range(24)]
+            channel.send(sizes)
+        """)
+        data = "x".encode("ascii") * (3 * 1024 * 1024)
+        def send():
+            for i in range(6):
+                channel.send(data)
+        threads = [threading.Thread(target=send) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert channel.receive(TESTTIMEOUT) == [len(data)] * 24
+
+    def test_register(self, gw):
+        def add(a, b):
+            return a + b
+        def fail():
+            raise ValueError(42)
+        handle = gw.register(add)
+        assert handle.call(a=1, b=2) == 3
+        calls = [handle.call_async(a=i, b=1) for i in range(10)]
+        assert [call.get(TESTTIMEOUT) for call in calls] == list(range(1, 11))
+        pytest.raises(execnet.RemoteError, gw.register(fail).call)
+        assert handle.call(a="x", b="y") == "xy"
+
+    def test_session(self, gw):
+        with gw.session() as session:
+            session.remote_exec("import os; counter = 0").waitclose(TESTTIMEOUT)
+            for i in range(3):
+                channel = session.remote_exec("""
+                    counter += 1
+                    channel.send((counter, 'os' in globals()))
+                """)
+                assert channel.receive(TESTTIMEOUT) == (i + 1, True)
+            channel = gw.remote_exec("channel.send('counter' in globals())")
+            assert not channel.receive(TESTTIMEOUT)
+        channel = gw.remote_exec("channel.send(channel.gateway._sessions)")
+        assert channel.receive(TESTTIMEOUT) == {}
+        pytest.raises(ValueError, lambda: session.remote_exec("pass"))
+
+    def test_session_overlapping_executions(self, gw):
+        with gw.session() as session:
+            first = session.remote_exec("""
+                import time
+                done = []
+                ownid = channel.id
+                time.sleep(0.5)
+                channel.send(channel.id == ownid)
+                done.append(channel.id)
+            """)
+            second = session.remote_exec("channel.send(done)")
+            assert first.receive(TESTTIMEOUT) is True
+            assert second.receive(TESTTIMEOUT) == [first.id]
+
+    def test_remote_exec_code_cache(self, gw):
+        size = gateway_base.CODE_CACHE_SIZE
+        for repeat in range(2):
+            channels = [gw.remote_exec("channel.send(%d)" % i)
+                        for i in range(size + 10)]
+            for i, channel in enumerate(channels):
+                assert channel.receive(TESTTIMEOUT) == i
+        channel = gw.remote_exec("channel.send(len(channel.gateway."
+                                 "_codecache._entries))")
+        assert channel.receive(TESTTIMEOUT) == size
+
+    def test_remote_exec_code_cache_failed_dump(self, gw):
+        def echo(channel, x):
+            channel.send(x)
+        pytest.raises(gateway_base.DumpError,
+                      lambda: gw.remote_exec(echo, x=object()))
+        channel = gw.remote_exec(echo, x=1)
+        assert channel.receive(TESTTIMEOUT) == 1
+
     def test__rinfo(self, gw):
         rinfo = gw._rinfo()
         assert rinfo.executable
@@ -355,6 +443,83 @@ class TestThreads:
                 return
         assert 0, "numexecuting didn't drop to zero"
 
+class TestCoalescingWriter:
+    def test_echo_many_items(self, makegateway):
+        gw = makegateway("popen//coalesce=0.01:4096")
+        assert gw._writer is not None
+        channel = gw.remote_exec('''
+            for item in channel:
+                channel.send(item)
+        ''')
+        for i in range(1000):
+            channel.send((i, "x" * i))
+        for i in range(1000):
+            assert channel.receive(TESTTIMEOUT) == (i, "x" * i)
+        assert gw.remote_status().numexecuting == 1
+        channel.close()
+        channel.waitclose(TESTTIMEOUT)
+
+    def test_status_during_large_sends(self, makegateway):
+        gw = makegateway("popen//coalesce")
+        channel = gw.remote_exec('''
+            for item in channel:
+                channel.send(len(item))
+        ''')
+        data = "x" * (gateway_base.WRITER_CHUNK_SIZE * 3)
+        for i in range(5):
+            channel.send(data)
+            channel.send((i, data))
+        # may overtake the queued data and even the remote_exec
+        assert gw.remote_status().execmodel == "thread"
+        for i in range(5):
+            assert channel.receive(TESTTIMEOUT) == len(data)
+            assert channel.receive(TESTTIMEOUT) == 2
+        channel.close()
+        channel.waitclose(TESTTIMEOUT)
+
+    def test_exit_flushes_queue(self, makegateway):
+        gw = makegateway("popen//coalesce=1.0")
+        channel = gw.remote_exec("channel.send(channel.receive())")
+        channel.send(42)
+        assert channel.receive(TESTTIMEOUT) == 42
+        gw.exit()
+        assert gw._writer._finished.wait(TESTTIMEOUT)
+
+    def test_write_error_closes_channels(self, makegateway):
+        gw = makegateway("popen//coalesce")
+        channel = gw.remote_exec("""
+            channel.send(1)
+            channel.send(channel.receive())
+        """)
+        assert channel.receive(TESTTIMEOUT) == 1
+        class BrokenIO:
+            def write(self, data):
+                raise IOError("broken pipe")
+        gw._writer._io = BrokenIO()
+        channel.send(42)
+        excinfo = py.test.raises(channel.RemoteError, channel.waitclose,
+                                 TESTTIMEOUT)
+        assert "broken pipe" in str(excinfo.value)
+        py.test.raises(IOError, channel.send, 43)
+        py.test.raises(IOError, gw.remote_status)
+
+class TestCompression:
+    def test_echo_compressed(self, makegateway):
+        gw = makegateway("popen//compress=zlib:3")
+        assert gw._compressor.level == 3
+        channel = gw.remote_exec("""
+            channel.send(channel.receive() * 2)
+            channel.send(channel.gateway._compressor.level)
+        """)
+        data = "x" * 100000
+        channel.send(data)
+        assert channel.receive(TESTTIMEOUT) == data * 2
+        assert channel.receive(TESTTIMEOUT) == 3
+        channel.waitclose(TESTTIMEOUT)
+
+    def test_unsupported_method(self, makegateway):
+        py.test.raises(ValueError, lambda: makegateway("popen//compress=xz"))
+
 class TestTracing:
     def test_popen_filetracing(self, testdir, monkeypatch, makegateway):
         tmpdir = testdir.tmpdir
@@ -85,6 +85,45 @@ def test_limited_size(execmodel):
     assert pool2.waitall()
     assert pool.waitall()
 
+def test_threads_are_reused(execmodel):
+    pool = WorkerPool(execmodel)
+    idents = set()
+    for i in range(10):
+        pool.spawn(lambda: idents.add(execmodel.get_ident())).get(1.0)
+        while not pool._idle:
+            execmodel.sleep(0.01)
+    assert len(idents) == 1
+    assert pool._numthreads == 1
+    pool.terminate(1.0)
+
+def test_maxsize_queues_spawns(execmodel):
+    pool = WorkerPool(execmodel, maxsize=2)
+    q = execmodel.queue.Queue()
+    replies = [pool.spawn(q.get) for i in range(4)]
+    assert pool._numthreads == 2
+    assert len(pool._backlog) == 2
+    for i in range(4):
+        q.put(i)
+    assert sorted(reply.get(1.0) for reply in replies) == [0, 1, 2, 3]
+    assert pool.waitall(1.0)
+    assert pool._numthreads == 2
+
+def test_idle_threads_finish(execmodel):
+    pool = WorkerPool(execmodel, minsize=1, idletimeout=0.05)
+    q = execmodel.queue.Queue()
+    replies = [pool.spawn(q.get) for i in range(3)]
+    for i in range(3):
+        q.put(i)
+    for reply in replies:
+        reply.get(1.0)
+    for i in range(100):
+        if pool._numthreads == 1:
+            break
+        execmodel.sleep(0.05)
+    assert pool._numthreads == 1
+    assert pool.spawn(lambda: 42).get(1.0) == 42
+    pool.terminate(1.0)
+
 def test_get(pool):
     def f():
         return 42